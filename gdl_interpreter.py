@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+A pure Python interpreter for the Game Description Language which works
+directly on the s-expression lists produced by parse() in ggp_python_player.py,
+so no Prolog process or text serialisation is needed.
+Relations which don't depend on true or does (role, init, successor tables
+and so on) are worked out bottom up once when the reasoner is created,
+everything else is proved top down for each state.
+"""
+import re
+
+TOKEN = re.compile(r'[(),]|[^(),\s]+')
+
+
+def is_var(term):
+    "Variables are title case after atom() in ggp_python_player.py"
+    return isinstance(term, str) and term[:1].isupper()
+
+def to_term(expr):
+    "Turn the nested lists produced by parse() into nested tuples which can be hashed"
+    if isinstance(expr, list):
+        return tuple(to_term(item) for item in expr)
+    return expr
+
+def term2str(term):
+    "Write a term the way Prolog's write/1 does, eg cell(1,1,x)"
+    if isinstance(term, tuple):
+        return term[0] + '(' + ','.join([term2str(arg) for arg in term[1:]]) + ')'
+    return term
+
+def str2term(text):
+    "Inverse of term2str"
+    tokens = TOKEN.findall(text)
+    term, idx = read_term(tokens, 0)
+    return term
+
+def read_term(tokens, idx):
+    "Recursive helper for str2term, returns the term and the index of the next token"
+    name = tokens[idx]
+    idx += 1
+    if idx == len(tokens) or tokens[idx] != '(':
+        return name, idx
+    args = [name]
+    while tokens[idx] != ')':
+        arg, idx = read_term(tokens, idx + 1)
+        args.append(arg)
+    return tuple(args), idx + 1
+
+def functor(term):
+    return term[0] if isinstance(term, tuple) else term
+
+def key(literal):
+    "Relations are indexed by name and arity"
+    if isinstance(literal, tuple):
+        return (literal[0], len(literal) - 1)
+    return (literal, 0)
+
+def walk(term, env):
+    while is_var(term) and term in env:
+        term = env[term]
+    return term
+
+def substitute(term, env):
+    term = walk(term, env)
+    if isinstance(term, tuple):
+        return tuple([substitute(arg, env) for arg in term])
+    return term
+
+def unify(term1, term2, env):
+    """
+    Returns an extended copy of env, or None if the terms don't unify
+    """
+    term1 = walk(term1, env)
+    term2 = walk(term2, env)
+    if term1 == term2:
+        return env
+    if is_var(term1):
+        env = dict(env)
+        env[term1] = term2
+        return env
+    if is_var(term2):
+        env = dict(env)
+        env[term2] = term1
+        return env
+    if isinstance(term1, tuple) and isinstance(term2, tuple) and len(term1) == len(term2):
+        for idx in range(len(term1)):
+            env = unify(term1[idx], term2[idx], env)
+            if env is None:
+                return None
+        return env
+    return None
+
+def variables(term, found = None):
+    "List of the distinct variables in a term, in order of appearance"
+    if found is None:
+        found = []
+    if is_var(term):
+        if term not in found:
+            found.append(term)
+    elif isinstance(term, tuple):
+        for arg in term:
+            variables(arg, found)
+    return found
+
+def variant(term):
+    "Rename variables so that goals differing only in variable names share a memo entry"
+    names = variables(term)
+    return substitute(term, dict([(names[idx], '?' + str(idx)) for idx in range(len(names))]))
+
+def dependencies(literal, found = None):
+    "Relation keys a body literal depends on, looking inside not and or"
+    if found is None:
+        found = set()
+    if isinstance(literal, tuple) and literal[0] in ('not', 'or'):
+        for sub in literal[1:]:
+            dependencies(sub, found)
+    elif isinstance(literal, tuple) and literal[0] == 'distinct':
+        pass
+    else:
+        found.add(key(literal))
+    return found
+
+def dynamic_keys(graph):
+    "The keys of graph which depend on true or does, directly or not"
+    dynamic = set([('true', 1), ('does', 2)])
+    changed = True
+    while changed:
+        changed = False
+        for head_key in graph:
+            if head_key not in dynamic and graph[head_key] & dynamic:
+                dynamic.add(head_key)
+                changed = True
+    return dynamic
+
+def strata(graph):
+    """
+    Tarjan's algorithm, written with an explicit stack since ground propnets can be
+    deeper than Python's recursion limit. graph maps each key to the keys it depends on.
+    Returns the strongly connected components with dependencies first
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in sorted(graph):
+        if root in index:
+            continue
+        work = [(root, iter(sorted(graph.get(root, ()))))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while len(work) > 0:
+            node, successors = work[-1]
+            pushed = False
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(sorted(graph.get(succ, ())))))
+                    pushed = True
+                    break
+                elif succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            if pushed:
+                continue
+            work.pop()
+            if len(work) > 0:
+                lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    succ = stack.pop()
+                    on_stack.discard(succ)
+                    component.append(succ)
+                    if succ == node:
+                        break
+                components.append(component)
+    return components
+
+
+class Symbols(object):
+    """
+    Interns names, such as base propositions like 'cell(1,1,x)' or moves, as small
+    integers. A state is an integer used as a bit array over its propositions' ids
+    """
+
+    def __init__(self, names = ()):
+        self.names = []
+        self.ids = {}
+        for name in names:
+            self.intern(name)
+
+    def intern(self, name):
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    def bits(self, names):
+        ret_int = 0
+        for name in names:
+            ret_int |= 1 << self.intern(name)
+        return ret_int
+
+    def members(self, bits):
+        "The names of the bits set in bits, in order of id"
+        ret_lst = []
+        while bits:
+            low = bits & -bits
+            ret_lst.append(self.names[low.bit_length() - 1])
+            bits ^= low
+        return ret_lst
+
+
+class PythonReasoner(object):
+    """
+    Implements the same reasoner interface as PrologReasoner:
+    roles, inits, legal, next, goal, terminal, status and advances.
+    States are bits over self.props and moves are ids in self.moves
+    """
+
+    def __init__(self, rules):
+        self.rules = {}
+        self.role_names = []
+        self.terms = {}
+        self.props = Symbols()
+        self.moves = Symbols()
+        self.renames = 0
+        graph = {}
+        for rule in rules:
+            rule = to_term(rule)
+            if isinstance(rule, tuple) and rule[0] == '<=':
+                head, body = rule[1], rule[2:]
+            else:
+                head, body = rule, ()
+            if key(head) == ('role', 1):
+                self.role_names.append(head[1])
+            self.rules.setdefault(key(head), []).append((head, body, variables(rule)))
+            deps = graph.setdefault(key(head), set())
+            for literal in body:
+                dependencies(literal, deps)
+        self.dynamic = dynamic_keys(graph)
+        self.static = {}
+        for component in strata(graph):
+            component = [head_key for head_key in component if head_key not in self.dynamic]
+            if len(component) > 0:
+                self.saturate(component)
+
+    def saturate(self, component):
+        "Bottom up fixpoint of one stratum of static relations"
+        for head_key in component:
+            self.static[head_key] = set()
+        context = self.context((), ())
+        changed = True
+        while changed:
+            changed = False
+            for head_key in component:
+                for head, body, names in self.rules.get(head_key, []):
+                    for env in self.prove(body, {}, context):
+                        fact = substitute(head, env)
+                        if fact not in self.static[head_key]:
+                            self.static[head_key].add(fact)
+                            changed = True
+
+    def context(self, state, does):
+        "Everything one query needs: the true and does facts plus its memo tables"
+        trues = {}
+        for prop in state:
+            trues.setdefault(functor(prop), []).append(prop)
+        return {'true': trues, 'does': does, 'memo': {}, 'open': {}, 'partial': {}, 'low': 0}
+
+    def rename(self, head, body, names):
+        self.renames += 1
+        suffix = '_' + str(self.renames)
+        env = dict([(name, name + suffix) for name in names])
+        return substitute(head, env), substitute(body, env)
+
+    def prove(self, goals, env, context):
+        "Generator of environments satisfying all goals"
+        if len(goals) == 0:
+            yield env
+        else:
+            for env1 in self.prove_literal(goals[0], env, context):
+                for env2 in self.prove(goals[1:], env1, context):
+                    yield env2
+
+    def prove_literal(self, literal, env, context):
+        name = functor(literal)
+        if name == 'not' and isinstance(literal, tuple):
+            for dummy in self.prove_literal(substitute(literal[1], env), {}, context):
+                return
+            yield env
+        elif name == 'distinct' and isinstance(literal, tuple):
+            if substitute(literal[1], env) != substitute(literal[2], env):
+                yield env
+        elif name == 'or' and isinstance(literal, tuple):
+            for disjunct in literal[1:]:
+                for env1 in self.prove_literal(disjunct, env, context):
+                    yield env1
+        elif name == 'true' and isinstance(literal, tuple):
+            pattern = walk(literal[1], env)
+            for prop in context['true'].get(functor(pattern), ()):
+                env1 = unify(pattern, prop, env)
+                if env1 is not None:
+                    yield env1
+        elif name == 'does' and isinstance(literal, tuple):
+            for fact in context['does']:
+                env1 = unify(literal, fact, env)
+                if env1 is not None:
+                    yield env1
+        elif key(literal) in self.static:
+            pattern = substitute(literal, env)
+            if len(variables(pattern)) == 0:
+                # a ground goal is just a lookup
+                if pattern in self.static[key(literal)]:
+                    yield env
+            else:
+                for fact in list(self.static[key(literal)]):
+                    env1 = unify(pattern, fact, env)
+                    if env1 is not None:
+                        yield env1
+        else:
+            for fact in self.answers(substitute(literal, env), context):
+                env1 = unify(literal, fact, env)
+                if env1 is not None:
+                    yield env1
+
+    def answers(self, goal, context):
+        """
+        All ground instances of a dynamic goal, memoised for the current query.
+        A goal which is already being worked on returns the answers found so far,
+        and the outermost goal of the loop is then re-evaluated until no new answers turn up.
+        Goals inside the loop aren't memoised until it is complete
+        """
+        goal_key = variant(goal)
+        if goal_key in context['memo']:
+            return context['memo'][goal_key]
+        if goal_key in context['open']:
+            context['low'] = min(context['low'], context['open'][goal_key])
+            return list(context['partial'][goal_key])
+        depth = len(context['open'])
+        context['open'][goal_key] = depth
+        outer_low = context['low']
+        found = []
+        seen = set()
+        context['partial'][goal_key] = found
+        while True:
+            context['low'] = depth + 1
+            before = len(found)
+            for rule in self.rules.get(key(goal), []):
+                head, body = self.rename(*rule)
+                env = unify(head, goal, {})
+                if env is None:
+                    continue
+                for env1 in self.prove(body, env, context):
+                    fact = substitute(goal, env1)
+                    if fact not in seen:
+                        seen.add(fact)
+                        found.append(fact)
+            if context['low'] != depth or len(found) == before:
+                break
+        low = context['low']
+        del context['open'][goal_key]
+        del context['partial'][goal_key]
+        context['low'] = min(outer_low, low)
+        if low > depth:
+            context['memo'][goal_key] = found
+        return found
+
+    def query(self, goal, state, does = ()):
+        return [substitute(goal, env) for env in self.prove((goal,), {}, self.context(self.state(state), does))]
+
+    def term(self, name):
+        "Convert a string into a term, caching the conversion"
+        if name not in self.terms:
+            self.terms[name] = str2term(name)
+        return self.terms[name]
+
+    def state(self, state):
+        "Convert a state's bits into a list of terms"
+        return [self.term(name) for name in self.props.members(state)]
+
+    def legal_moves(self, context):
+        "Move ids for each role, in order of name so a state always lists them alike"
+        ret_lst = [set() for dummy in self.role_names]
+        for env in self.prove((('legal', 'R', 'M'),), {}, context):
+            ret_lst[self.role_names.index(substitute('R', env))].add(term2str(substitute('M', env)))
+        return [[self.moves.intern(name) for name in sorted(move_set)] for move_set in ret_lst]
+
+    def goal_values(self, context):
+        ret_lst = [0 for dummy in self.role_names]
+        for env in self.prove((('goal', 'R', 'N'),), {}, context):
+            ret_lst[self.role_names.index(substitute('R', env))] = int(substitute('N', env))
+        return tuple(ret_lst)
+
+    def roles(self):
+        return list(self.role_names)
+
+    def init_terms(self):
+        return [fact[1] for fact in self.static.get(('init', 1), ())]
+
+    def inits(self):
+        return self.props.bits(sorted(set([term2str(prop) for prop in self.init_terms()])))
+
+    def legal(self, state):
+        return self.legal_moves(self.context(self.state(state), ()))
+
+    def next(self, moves, state):
+        does = [('does', self.role_names[idx], self.term(self.moves.names[moves[idx]])) \
+          for idx in range(len(moves))]
+        return self.props.bits([term2str(fact[1]) for fact in self.query(('next', 'B'), state, does)])
+
+    def goal(self, state):
+        return self.goal_values(self.context(self.state(state), ()))
+
+    def terminal(self, state):
+        for dummy in self.prove(('terminal',), {}, self.context(self.state(state), ())):
+            return True
+        return False
+
+    def status(self, state):
+        """
+        (terminal, legal, values) with legal None if terminal and values None if not.
+        The queries share one context so views like line are only proved once
+        """
+        context = self.context(self.state(state), ())
+        for dummy in self.prove(('terminal',), {}, context):
+            return (True, None, self.goal_values(context))
+        return (False, self.legal_moves(context), None)
+
+    def advances(self, steps):
+        "steps is a list of (moves, state), returns a list of (next state, status of next state)"
+        ret_lst = []
+        for moves, state in steps:
+            next_state = self.next(moves, state)
+            ret_lst.append((next_state, self.status(next_state)))
+        return ret_lst
+
+    def close(self):
+        pass
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+Compiles GDL rules into a propositional network.
+The rules are grounded against an over-approximation of everything that can
+become true (negations ignored), every ground atom gets an index into a
+bytearray, and the view propositions are written out as one Python function
+per phase in topological order, much as prolog_rules writes out a Prolog program.
+States are kept as integers used as bit arrays over the base propositions.
+"""
+from gdl_interpreter import PythonReasoner, Symbols, key, substitute, unify, variables, term2str, strata
+
+
+def expand_or(body):
+    "Returns a list of bodies without or, one per combination of disjuncts"
+    bodies = [[]]
+    for literal in body:
+        if isinstance(literal, tuple) and literal[0] == 'or':
+            alternatives = [[disjunct] for disjunct in literal[1:]]
+        elif isinstance(literal, tuple) and literal[0] == 'not' and \
+          isinstance(literal[1], tuple) and literal[1][0] == 'or':
+            alternatives = [[('not', disjunct) for disjunct in literal[1][1:]]]
+        else:
+            alternatives = [[literal]]
+        bodies = [previous + alternative for previous in bodies for alternative in alternatives]
+    return bodies
+
+def positive(literal):
+    return not (isinstance(literal, tuple) and literal[0] in ('not', 'distinct'))
+
+def join(body, env, facts):
+    "Generator of environments matching the positive literals of body against facts"
+    if len(body) == 0:
+        yield env
+    else:
+        literal = body[0]
+        bound = substitute(literal, env)
+        if ground(bound):
+            if bound in facts.get(key(literal), ()):
+                for env2 in join(body[1:], env, facts):
+                    yield env2
+            return
+        for fact in facts.get(key(literal), ()):
+            env1 = unify(literal, fact, env)
+            if env1 is not None:
+                for env2 in join(body[1:], env1, facts):
+                    yield env2
+
+def ground(term):
+    return len(variables(term)) == 0
+
+def define(source):
+    "Returns the update function written out by PropnetReasoner.write_function"
+    namespace = {}
+    exec(compile(source, '<propnet>', 'exec'), namespace)
+    return namespace['update']
+
+
+class PropnetReasoner(object):
+    """
+    Implements the reasoner interface of PrologReasoner and PythonReasoner
+    by evaluating a propositional network instead of proving queries
+    """
+
+    def __init__(self, rules):
+        interpreter = PythonReasoner(rules)
+        self.role_names = interpreter.roles()
+        self.init_state = [term2str(prop) for prop in interpreter.init_terms()]
+        static = interpreter.static
+        dynamic_rules = []
+        for head_key in interpreter.dynamic:
+            for head, body, names in interpreter.rules.get(head_key, []):
+                for expanded in expand_or(body):
+                    dynamic_rules.append((head, [literal for literal in expanded if positive(literal)],
+                      [literal for literal in expanded if not positive(literal)]))
+        facts = self.relax(dynamic_rules, static, interpreter.init_terms())
+        self.instantiate(dynamic_rules, static, facts)
+        self.compile()
+
+    def relax(self, dynamic_rules, static, inits):
+        """
+        Bottom up fixpoint ignoring not and distinct, where true is fed by init and next,
+        and does by legal. Returns every atom which could possibly be true
+        """
+        facts = dict(static)
+        facts[('true', 1)] = set([('true', prop) for prop in inits])
+        facts[('does', 2)] = set()
+        changed = True
+        while changed:
+            changed = False
+            for head, body, dummy in dynamic_rules:
+                for fact in [substitute(head, env) for env in join(body, {}, facts)]:
+                    if ground(fact) and fact not in facts.setdefault(key(fact), set()):
+                        facts[key(fact)].add(fact)
+                        changed = True
+            for fact in list(facts.get(('next', 1), ())):
+                if ('true', fact[1]) not in facts[('true', 1)]:
+                    facts[('true', 1)].add(('true', fact[1]))
+                    changed = True
+            for fact in list(facts.get(('legal', 2), ())):
+                if ('does',) + fact[1:] not in facts[('does', 2)]:
+                    facts[('does', 2)].add(('does',) + fact[1:])
+                    changed = True
+        return facts
+
+    def instantiate(self, dynamic_rules, static, facts):
+        """
+        Number every ground atom and give each view proposition its list of
+        conjunctions of (index, positive) literals
+        """
+        self.atoms = []
+        self.index = {}
+        self.sentences = {}
+
+        def number(atom):
+            if atom not in self.index:
+                self.index[atom] = len(self.atoms)
+                self.atoms.append(atom)
+            return self.index[atom]
+
+        for fact in sorted(facts[('true', 1)], key = term2str):
+            number(fact)
+        self.base_count = len(self.atoms)
+        for fact in sorted(facts[('does', 2)], key = term2str):
+            number(fact)
+        self.input_count = len(self.atoms) - self.base_count
+        for head_key in (('legal', 2), ('goal', 2), ('terminal', 0), ('next', 1)):
+            # relations which hold in every state, such as legal moves with only static conditions
+            for fact in sorted(static.get(head_key, ()), key = term2str):
+                self.sentences.setdefault(number(fact), []).append([])
+        for head, body, tests in dynamic_rules:
+            for env in join(body, {}, facts):
+                conjunction = []
+                for literal in body:
+                    atom = substitute(literal, env)
+                    if key(atom) not in static:
+                        conjunction.append((number(atom), True))
+                for literal in tests:
+                    atom = substitute(literal, env)
+                    if not ground(atom):
+                        conjunction = None
+                        break
+                    if atom[0] == 'distinct':
+                        if atom[1] == atom[2]:
+                            conjunction = None
+                            break
+                    elif key(atom[1]) in static:
+                        if atom[1] in static[key(atom[1])]:
+                            conjunction = None
+                            break
+                    elif atom[1] in facts.get(key(atom[1]), ()):
+                        conjunction.append((number(atom[1]), False))
+                if conjunction is not None:
+                    self.sentences.setdefault(number(substitute(head, env)), []).append(conjunction)
+
+    def compile(self):
+        """
+        Write the view propositions out as two Python functions in topological order:
+        update_state for everything which only depends on true, and
+        update_next for everything which depends on does
+        """
+        graph = {}
+        for prop in self.sentences:
+            graph[prop] = set([idx for conjunction in self.sentences[prop] for idx, sign in conjunction])
+        inputs = set(range(self.base_count, self.base_count + self.input_count))
+        uses_does = set()
+        order = [component for component in strata(graph) if component[0] in self.sentences]
+        for component in order:
+            if any([graph[prop] & (inputs | uses_does) for prop in component]):
+                uses_does.update(component)
+        self.legals = []
+        self.goals = []
+        self.terminals = []
+        self.nexts = []
+        for atom in self.atoms:
+            idx = self.index[atom]
+            if atom[0] == 'legal':
+                self.legals.append((self.role_names.index(atom[1]), term2str(atom[2]), idx))
+            elif atom[0] == 'goal':
+                self.goals.append((self.role_names.index(atom[1]), int(atom[2]), idx))
+            elif atom == 'terminal':
+                self.terminals.append(idx)
+            elif atom[0] == 'next' and ('true', atom[1]) in self.index:
+                self.nexts.append((idx, self.index[('true', atom[1])]))
+        self.props = Symbols([term2str(atom[1]) for atom in self.atoms[:self.base_count]])
+        self.moves = Symbols(sorted(set([move for role_idx, move, idx in self.legals])))
+        self.legals = [(role_idx, self.moves.ids[move], idx) for role_idx, move, idx in sorted(self.legals)]
+        self.inputs = dict([((atom[1], self.moves.intern(term2str(atom[2]))), self.index[atom]) \
+          for atom in self.atoms if atom[0] == 'does'])
+        self.state_source = self.write_function([component for component in order \
+          if component[0] not in uses_does])
+        self.next_source = self.write_function([component for component in order \
+          if component[0] in uses_does])
+        self.define()
+
+    def define(self):
+        self.update_state = define(self.state_source)
+        self.update_next = define(self.next_source)
+        self.loaded = None
+        self.values = bytearray(len(self.atoms))
+
+    def __getstate__(self):
+        "The compiled functions can't be pickled, so they are rebuilt from their source"
+        state = dict(self.__dict__)
+        for name in ('update_state', 'update_next', 'loaded', 'values'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.define()
+
+    def write_function(self, order):
+        lines = ['def update(v):']
+        for component in order:
+            recursive = len(component) > 1 or component[0] in [idx for conjunction in \
+              self.sentences[component[0]] for idx, sign in conjunction]
+            indent = '    '
+            if recursive:
+                lines.append('    while True:')
+                lines.append('        old = (' + ''.join(['v[%d], ' % prop for prop in component]) + ')')
+                indent = '        '
+            for prop in component:
+                disjuncts = []
+                for conjunction in self.sentences[prop]:
+                    if len(conjunction) == 0:
+                        disjuncts = ['1']
+                        break
+                    disjuncts.append('(' + ' and '.join([('v[%d]' if sign else 'not v[%d]') % idx \
+                      for idx, sign in conjunction]) + ')')
+                lines.append(indent + 'v[%d] = 1 if %s else 0' % (prop, ' or '.join(disjuncts) or '0'))
+            if recursive:
+                lines.append('        if old == (' + ''.join(['v[%d], ' % prop for prop in component]) + '):')
+                lines.append('            break')
+        lines.append('    return v')
+        return '\n'.join(lines) + '\n'
+
+    def load(self, state):
+        """
+        Set the base propositions and evaluate update_state, unless state is already loaded.
+        The ids in self.props are the base propositions' indices, so state is used as is
+        """
+        if state != self.loaded:
+            values = self.values
+            for idx in range(self.base_count):
+                values[idx] = (state >> idx) & 1
+            self.update_state(values)
+            self.loaded = state
+        return self.values
+
+    def factors(self):
+        """
+        Splits the game into independent subgames, returned as a list of
+        (base proposition names, move names) with one entry per subgame.
+        Base propositions appearing together in a conjunction are linked, a move is linked
+        to the base propositions its legal needs and those it makes true or false, and
+        moves with the same name are linked. Base propositions whose next doesn't depend
+        on any move, such as whose turn it is or a step counter, are shared by all the
+        subgames rather than linking them, and so are moves left linked to nothing, such
+        as noop. A move which merely lets a proposition stay as it is, as in the usual
+        frame rules, doesn't link them either, so the split is a heuristic one
+        """
+        leaves = self.base_count + self.input_count
+        inputs = set(range(self.base_count, leaves))
+        moved = set()
+        for idx, base in self.nexts:
+            # the base propositions and moves next depends on, through any views
+            stack = [idx]
+            seen = set(stack)
+            while len(stack) > 0 and base not in moved:
+                for conjunction in self.sentences.get(stack.pop(), ()):
+                    for literal, sign in conjunction:
+                        if literal in inputs:
+                            moved.add(base)
+                        elif literal >= leaves and literal not in seen:
+                            seen.add(literal)
+                            stack.append(literal)
+        parent = {}
+
+        def find(idx):
+            while parent.setdefault(idx, idx) != idx:
+                idx = parent[idx]
+            return idx
+
+        def link(idx1, idx2):
+            parent[find(idx1)] = find(idx2)
+
+        for prop in self.sentences:
+            for conjunction in self.sentences[prop]:
+                bases = [literal for literal, sign in conjunction if literal in moved]
+                for literal in bases[1:]:
+                    link(bases[0], literal)
+        for idx, base in self.nexts:
+            for conjunction in self.sentences.get(idx, ()):
+                persists = (base, True) in conjunction
+                for literal, sign in conjunction:
+                    if literal in moved or (literal in inputs and not (persists and sign)):
+                        link(base, literal)
+        for role_idx, move, idx in self.legals:
+            if (self.role_names[role_idx], move) in self.inputs:
+                for conjunction in self.sentences.get(idx, ()):
+                    for literal, sign in conjunction:
+                        if literal in moved:
+                            link(self.inputs[(self.role_names[role_idx], move)], literal)
+        named = {}
+        for (role, move), idx in self.inputs.items():
+            link(named.setdefault(move, idx), idx)
+        subgames = {}
+        for base in moved:
+            subgames.setdefault(find(base), (set(), set()))[0].add(term2str(self.atoms[base][1]))
+        for (role, move), idx in self.inputs.items():
+            if find(idx) in subgames:
+                subgames[find(idx)][1].add(self.moves.names[move])
+        return sorted([(sorted(props), sorted(moves)) for props, moves in subgames.values() if len(moves) > 0])
+
+    def roles(self):
+        return list(self.role_names)
+
+    def inits(self):
+        return self.props.bits(self.init_state)
+
+    def legal(self, state):
+        values = self.load(state)
+        ret_lst = [[] for dummy in self.role_names]
+        for role_idx, move, idx in self.legals:
+            if values[idx]:
+                ret_lst[role_idx].append(move)
+        return ret_lst
+
+    def next(self, moves, state):
+        values = self.load(state)
+        does = [self.inputs[(self.role_names[idx], moves[idx])] for idx in range(len(moves)) \
+          if (self.role_names[idx], moves[idx]) in self.inputs]
+        for idx in does:
+            values[idx] = 1
+        self.update_next(values)
+        for idx in does:
+            values[idx] = 0
+        ret_int = 0
+        for idx, base in self.nexts:
+            if values[idx]:
+                ret_int |= 1 << base
+        return ret_int
+
+    def goal(self, state):
+        values = self.load(state)
+        ret_lst = [0 for dummy in self.role_names]
+        for role_idx, value, idx in self.goals:
+            if values[idx]:
+                ret_lst[role_idx] = value
+        return tuple(ret_lst)
+
+    def terminal(self, state):
+        values = self.load(state)
+        return any([values[idx] for idx in self.terminals])
+
+    def status(self, state):
+        "(terminal, legal, values) with legal None if terminal and values None if not"
+        if self.terminal(state):
+            return (True, None, self.goal(state))
+        return (False, self.legal(state), None)
+
+    def advances(self, steps):
+        "steps is a list of (moves, state), returns a list of (next state, status of next state)"
+        ret_lst = []
+        for moves, state in steps:
+            next_state = self.next(moves, state)
+            ret_lst.append((next_state, self.status(next_state)))
+        return ret_lst
+
+    def close(self):
+        pass
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how fast each reasoner and the player's depthcharges run on the games
+in games/, so that performance regressions show up and a reasoner can be picked
+per game. For each game and reasoner it reports the time taken to build the
+reasoner, nodes (plies) and playouts per second of fixed seed random playouts
+calling the reasoner directly, depthcharges per second through the player's own
+tree and batching, the 50th, 90th and 99th percentile latencies of the legal,
+next, terminal and goal queries behind findmoves, findnext, findterminalp and
+findreward, and the peak memory of the process which ran it. Each of the two
+playout loops stops after the given number of playouts or seconds, whichever
+comes first, so a slow reasoner on a big game reports a rate over fewer playouts.
+The player's depthcharges can be cut off after a given number of plies, as with -l.
+With -c the reasoners are instead checked against the Python interpreter along
+the same random playouts.
+
+python2.7 ggp_benchmark.py
+python2.7 ggp_benchmark.py -r propnet -n 200 games/breakthrough.kif
+python2.7 ggp_benchmark.py -c -r prolog propnet
+"""
+from __future__ import print_function
+import argparse, glob, os, re, random, resource, time, multiprocessing
+from distutils.spawn import find_executable
+import ggp_python_player as player
+
+GAMES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'games', '*.kif')
+PLAYOUTS = 50
+SECONDS = 60
+SEED = 1
+QUERIES = ['legal', 'next', 'terminal', 'goal']
+
+
+def load_rules(path):
+    "Reads a .kif file, dropping ; comments"
+    return player.parse('(' + re.sub(r';[^\n]*', '', open(path).read()) + ')')
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def timed(latencies, query, function, *args):
+    "Calls function with args, adding how long it took to latencies[query]"
+    started = time.time()
+    result = function(*args)
+    latencies[query].append(time.time() - started)
+    return result
+
+def benchmark(path, reasoner_name, playouts, seconds, seed, depth_limit = 0):
+    """
+    Runs in a process of its own, so the peak memory is that of this game and reasoner.
+    Returns a dictionary of the measurements
+    """
+    player.REASONER = reasoner_name
+    player.PLAYOUT_DEPTH = depth_limit
+    rules = load_rules(path)
+    started = time.time()
+    reasoner = player.new_reasoner(rules)
+    result = {'build': time.time() - started}
+    random.seed(seed)
+    latencies = dict([(query, []) for query in QUERIES])
+    plies = 0
+    count = 0
+    started = time.time()
+    while count < playouts and (count == 0 or time.time() < started + seconds):
+        state = reasoner.inits()
+        while not timed(latencies, 'terminal', reasoner.terminal, state):
+            legal = timed(latencies, 'legal', reasoner.legal, state)
+            moves = tuple([random.choice(role_moves) for role_moves in legal])
+            state = timed(latencies, 'next', reasoner.next, moves, state)
+            plies += 1
+        timed(latencies, 'goal', reasoner.goal, state)
+        count += 1
+    elapsed = time.time() - started
+    result['nodes'] = plies / elapsed
+    result['playouts'] = count / elapsed
+    for query in QUERIES:
+        result[query] = [percentile(latencies[query], fraction) for fraction in (0.5, 0.9, 0.99)]
+    random.seed(seed)
+    game = {'tree': {}, 'clock': 0, 'game_id': 'benchmark', 'reasoner': reasoner}
+    state = player.findinits(game)
+    count = 0
+    started = time.time()
+    while count < playouts and (count == 0 or time.time() < started + seconds):
+        count += player.depthcharges(state, game, started + 3600, player.PLAYOUT_BATCH)[1]
+        player.prune(game)
+    result['depthcharges'] = count / (time.time() - started)
+    reasoner.close()
+    # kilobytes on Linux
+    result['memory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return result
+
+def plain(name):
+    "A prop or move name without the spaces a reasoner may print it with"
+    return re.sub(r'\s', '', name)
+
+def crosscheck(path, reasoner_name, playouts, seed):
+    """
+    Plays fixed seed random playouts with both the given reasoner and the Python
+    interpreter, comparing roles, initial and next states, legal moves, terminal
+    and goals at every ply by name, since each reasoner numbers them its own way.
+    Returns the plies checked and a description of the first difference, or None
+    """
+    player.REASONER = 'python'
+    reference = player.new_reasoner(load_rules(path))
+    player.REASONER = reasoner_name
+    reasoner = player.new_reasoner(load_rules(path))
+    random.seed(seed)
+    plies = 0
+    difference = None
+    if reasoner.roles() != reference.roles():
+        difference = 'roles %s, python %s' % (reasoner.roles(), reference.roles())
+    for dummy in range(playouts):
+        if difference is not None:
+            break
+        state, reference_state = reasoner.inits(), reference.inits()
+        while difference is None:
+            got = sorted([plain(name) for name in reasoner.props.members(state)])
+            expected = sorted([plain(name) for name in reference.props.members(reference_state)])
+            if got != expected:
+                difference = 'state %s, python %s' % (got, expected)
+                break
+            terminal = reasoner.terminal(state)
+            if terminal != reference.terminal(reference_state):
+                difference = 'terminal %s in %s' % (terminal, got)
+                break
+            if terminal:
+                if reasoner.goal(state) != reference.goal(reference_state):
+                    difference = 'goals %s, python %s in %s' % (reasoner.goal(state),
+                      reference.goal(reference_state), got)
+                break
+            legal = reasoner.legal(state)
+            reference_legal = reference.legal(reference_state)
+            by_name = [dict([(plain(reasoner.moves.names[move]), move) for move in role_moves]) \
+              for role_moves in legal]
+            reference_names = [[plain(reference.moves.names[move]) for move in role_moves] \
+              for role_moves in reference_legal]
+            got_legal = [sorted(role_moves) for role_moves in by_name]
+            expected_legal = [sorted(role_moves) for role_moves in reference_names]
+            if got_legal != expected_legal:
+                difference = 'legal %s, python %s in %s' % (got_legal, expected_legal, got)
+                break
+            choices = [random.randrange(len(role_moves)) for role_moves in reference_legal]
+            reference_moves = tuple([reference_legal[idx][choices[idx]] for idx in range(len(choices))])
+            moves = tuple([by_name[idx][reference_names[idx][choices[idx]]] for idx in range(len(choices))])
+            state, reference_state = reasoner.next(moves, state), reference.next(reference_moves, reference_state)
+            plies += 1
+    reasoner.close()
+    reference.close()
+    return plies, difference
+
+def report(path, reasoner_name, result):
+    print('%-16s %-8s %7.2fs %9.0f nodes/s %7.1f playouts/s %7.1f depthcharges/s %6.1f MB' % \
+      (os.path.basename(path), reasoner_name, result['build'], result['nodes'], result['playouts'],
+      result['depthcharges'], result['memory']))
+    for query in QUERIES:
+        print('    %-9s' % query + ' '.join(['%9.1fus' % (1e6 * latency) for latency in result[query]]))
+
+if __name__ == '__main__':
+    reasoners = ['python', 'propnet']
+    if find_executable(player.PROLOG[0]) is not None:
+        reasoners.insert(0, 'prolog')
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("games", help="GDL files, default " + GAMES, nargs='*')
+    arg_parser.add_argument("-r", "--reasoner", help="reasoners to compare, default " + ' '.join(reasoners),
+      nargs='+', choices=['prolog', 'python', 'propnet'])
+    arg_parser.add_argument("-n", "--playouts", help="playouts per game and reasoner, default " + str(PLAYOUTS),
+      type=int, default=PLAYOUTS)
+    arg_parser.add_argument("-t", "--seconds", help="seconds per playout loop, default " + str(SECONDS),
+      type=float, default=SECONDS)
+    arg_parser.add_argument("-l", "--depth-limit", help="plies after which the player's depthcharges are "
+      "scored by its heuristic, 0 for no limit, default 0", type=int, default=0)
+    arg_parser.add_argument("-s", "--seed", help="random seed, default " + str(SEED), type=int, default=SEED)
+    arg_parser.add_argument("-c", "--check", help="instead of timing them, check the reasoners against "
+      "-r python along the same random playouts", action="store_true")
+    args = arg_parser.parse_args()
+    if args.check:
+        for path in args.games or sorted(glob.glob(GAMES)):
+            for reasoner_name in args.reasoner or reasoners:
+                if reasoner_name == 'python':
+                    continue
+                pool = multiprocessing.Pool(1)
+                plies, difference = pool.apply(crosscheck, (path, reasoner_name, args.playouts, args.seed))
+                pool.close()
+                pool.join()
+                print('%-16s %-8s %7d plies %s' % (os.path.basename(path), reasoner_name, plies,
+                  'agree with python' if difference is None else 'differ: ' + difference))
+        raise SystemExit
+    print('%-16s %-8s %8s %17s %18s %22s %9s' % ('game', 'reasoner', 'build', 'nodes', 'playouts',
+      'depthcharges', 'memory'))
+    print('    %-9s%11s %11s %11s' % ('query', 'p50', 'p90', 'p99'))
+    for path in args.games or sorted(glob.glob(GAMES)):
+        for reasoner_name in args.reasoner or reasoners:
+            # a fresh process per run so each has its own peak memory
+            pool = multiprocessing.Pool(1)
+            report(path, reasoner_name, pool.apply(benchmark, (path, reasoner_name, args.playouts,
+              args.seconds, args.seed, args.depth_limit)))
+            pool.close()
+            pool.join()
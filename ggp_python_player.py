@@ -7,7 +7,9 @@ It is open source software written by a hobby programer, Robert Laing
 https://github.com/roblaing/ggp_python_player
 """
 from __future__ import print_function
-import BaseHTTPServer, time, argparse, subprocess, random, itertools
+import BaseHTTPServer, SocketServer, re, os, time, hashlib, mmap, cPickle, argparse, subprocess, random, multiprocessing, signal, math, threading, json, collections, itertools, tempfile
+from gdl_interpreter import PythonReasoner, Symbols, to_term, term2str, key, dependencies, dynamic_keys, strata
+from gdl_propnet import PropnetReasoner
 
 HOST_NAME = "127.0.0.1"
 PORT = 9147
@@ -15,196 +17,1109 @@ PLAYER_NAME = "roblaing"
 PROLOG = ['swipl','-s', '/dev/stdin']
 # PROLOG = ['yap','-L', '/dev/stdin']
 TIME_MARGIN = 0.9
+MIN_RESERVE = 0.05
+DECIDE_INTERVAL = 0.1
+PROLOG_LOOP = """
+ggp_main :- write(ready), nl, flush_output, ggp_serve.
+ggp_serve :- read(Query), ( Query == end_of_file -> halt ; ggp_answer(Query), nl, flush_output, ggp_serve ).
+ggp_answer(ggp_query(Trues, Does, Query)) :-
+    retractall(true(_)), retractall(does(_, _)),
+    forall(member(B, Trues), assertz(true(B))),
+    forall(member(D, Does), assertz(D)),
+    ggp_fresh,
+    ggp_reply(Query).
+ggp_reply(init) :- findall(B, init(B), L), ggp_props(L, Ns), ggp_line(Ns).
+ggp_reply(legal) :- ggp_legal(Ns), ggp_line(Ns).
+ggp_reply(next) :- findall(B, next(B), L), ggp_props(L, Ns), ggp_line(Ns).
+ggp_reply(goal) :- ggp_goal(Ns), ggp_line(Ns).
+ggp_reply(terminal) :- ( terminal -> ggp_line([1]) ; ggp_line([0]) ).
+ggp_reply(status) :- ( terminal -> ggp_goal(Ns), ggp_line([1|Ns]) ; ggp_legal(Ns), ggp_line([0|Ns]) ).
+ggp_reply(advance) :- findall(B, next(B), L), ggp_props(L, Ns), ggp_line(Ns), nl,
+    retractall(true(_)), retractall(does(_, _)),
+    forall(member(B, L), assertz(true(B))),
+    ggp_fresh,
+    ggp_reply(status).
+ggp_legal(Ns) :- findall(I-M, (legal(R, M), ggp_role(R, I)), L0), sort(L0, L), ggp_moves(L, Ns).
+ggp_goal(Ns) :- findall(I-N, (goal(R, N), ggp_role(R, I)), L0), sort(L0, L), ggp_pairs(L, Ns).
+ggp_props(L0, Ns) :- sort(L0, L), findall(N, (member(B, L), ggp_id(B, p, N)), Ns).
+ggp_moves([], []).
+ggp_moves([I-M|T], [I, N|Ns]) :- ggp_id(M, m, N), ggp_moves(T, Ns).
+ggp_pairs([], []).
+ggp_pairs([I-N|T], [I, N|Ns]) :- ggp_pairs(T, Ns).
+ggp_id(Term, Kind, N) :- ggp_symbol(Term, Kind, N), !.
+ggp_id(Term, Kind, N) :- retract(ggp_count(Kind, N)), N1 is N + 1, assertz(ggp_count(Kind, N1)),
+    assertz(ggp_symbol(Term, Kind, N)), write(Kind), write(' '), write(Term), nl.
+ggp_line(Ns) :- forall(member(N, Ns), (write(N), write(' '))).
+ggp_count(p, 0).
+ggp_count(m, 0).
+"""
 DOT_FILE_NAME = False
+EXPORT_DEPTH = 0
+EXPORT_VISITS = 0
+EXPORT_TOP = 0
+REASONER = 'prolog'
+WORKERS = 0
+DEPTHCHARGE_SLICE = 0.05
+UCT_CONSTANT = 1.4
+PLAYOUT_BATCH = 4
+PLAYOUT_DEPTH = 0
+MAX_NODES = 100000
+PRUNE_TO = 0.9
+EVICTION = 'lru'
+TOKEN = re.compile(r'[()]|[^\s()]+')
+READ_SIZE = 65536
+PONDER = True
+PONDER_SLICE = 0.1
+CACHE_DIR = False
+CACHE_NODES = 20000
+CACHE_FORMAT = 4
+INSTRUMENT = False
+FACTOR = False
+
+
+class Node(object):
+    """
+    One state in game['tree']. legals holds a tuple of legal move ids per role,
+    actions maps each joint move (a tuple of move ids, one per role) tried so far to
+    an Edge, stats holds a {move id: [summed score, count]} per role over the joint
+    moves tried from here, values are the goals of each role, estimate is what
+    evaluate makes of them if the node isn't terminal, proven the values solve has
+    proved best play leads to, and score_count is the summed values of the
+    depthcharges through the node followed by their count
+    """
+    __slots__ = ('terminal', 'values', 'estimate', 'proven', 'legals', 'actions', 'stats', 'score_count', 'used')
+
+    def __init__(self):
+        self.terminal = None
+        self.values = None
+        self.estimate = None
+        self.proven = None
+        self.legals = None
+        self.actions = None
+        self.stats = None
+        self.score_count = None
+        self.used = 0
+
+class Edge(object):
+    "A joint move out of a Node with the state it leads to and its own score_count"
+    __slots__ = ('next', 'score_count')
+
+    def __init__(self):
+        self.next = None
+        self.score_count = None
+
+def depthcharges(state, game, timeout, count = 1):
+    """
+    Runs count depthcharges from state in lockstep. It's a loop rather than recursion
+    so long games don't hit Python's recursion limit, and each step fetches the next
+    states of all the playouts still running, along with their terminal status and legal
+    moves or goals, in one batched call to the reasoner. A playout ends as soon as it
+    reaches a state whose values are known, terminal or proven by solve. Playouts still
+    running after PLAYOUT_DEPTH plies (0 for no limit), or at timeout, are scored by evaluate.
+    Returns the summed values and the number of depthcharges
+    """
+    roles = findroles(game)
+    values = [0 for dummy in roles]
+    states = [state for dummy in range(count)]
+    plies = 0
+    depth = 0
+    while len(states) > 0:
+        steps = []
+        cutoff = time.time() > timeout or (PLAYOUT_DEPTH > 0 and depth >= PLAYOUT_DEPTH)
+        for state in states:
+            known = solved(state, game)
+            if known is not None:
+                values = [values[idx] + known[idx] for idx in range(len(roles))]
+            elif cutoff:
+                estimate = evaluate(state, game)
+                values = [values[idx] + estimate[idx] for idx in range(len(roles))]
+            else:
+                steps.append((tuple([random.choice(role_moves) for role_moves in findmoves(state, game)]), state))
+        depth += 1
+        plies += len(steps)
+        prefetch(steps, game)
+        states = [findnext(move, state, game) for move, state in steps]
+    if 'stats' in game:
+        game['stats']['depthcharges'] += count
+        game['stats']['plies'] += plies
+    return (values, count)
+
+def evaluate(state, game):
+    """
+    Estimates the values of a state which isn't terminal, memoised in its node, as the
+    average for each role of up to three features worked out from the rules: the goal
+    the rules give the state, the role's share of the pieces, and its share of the
+    legal moves if more than one role has a choice. A piece is a true base proposition
+    naming the role along with at least two other arguments, such as cellholds(1,2,white)
+    """
+    node = findnode(state, game)
+    if node.estimate is None:
+        roles = findroles(game)
+        features = [ask(game, 'goal', state)]
+        owners = game.setdefault('owners', {})
+        pieces = [0 for dummy in roles]
+        for name in game['reasoner'].props.members(state):
+            if name not in owners:
+                args = [arg for arg in re.split(r'[(),\s]+', name)[1:] if arg != '']
+                named = [roles.index(arg) for arg in args if arg in roles]
+                owners[name] = named[0] if len(named) == 1 and len(args) > 2 else None
+            if owners[name] is not None:
+                pieces[owners[name]] += 1
+        if sum(pieces) > 0:
+            features.append([100.0 * piece_count / sum(pieces) for piece_count in pieces])
+        choices = [len(role_moves) for role_moves in findmoves(state, game)]
+        if len([choice for choice in choices if choice > 1]) > 1:
+            features.append([100.0 * choice / sum(choices) for choice in choices])
+        node.estimate = tuple([sum([feature[idx] for feature in features]) / float(len(features)) \
+          for idx in range(len(roles))])
+    return node.estimate
 
+def solved(state, game):
+    "The values of state if they are known: its goals if it's terminal, else those proven by solve or None"
+    node = findnode(state, game)
+    if node.terminal is None:
+        findterminalp(state, game)
+    if node.terminal:
+        if node.values is None:
+            findreward(findroles(game)[0], state, game)
+        return node.values
+    return node.proven
+
+def prove(state, game):
+    """
+    The values best play leads to from state if its children's prove them, else None.
+    Only states where at most one role has a choice are proved: by a child giving the
+    mover 100, or once every child is solved by the one giving the mover most.
+    Simultaneous choices would need their matrix game solved, so aren't
+    """
+    node = game['tree'].get(state)
+    if node is None or node.terminal is not False or node.legals is None or node.actions is None:
+        return None
+    movers = [idx for idx in range(len(node.legals)) if len(node.legals[idx]) > 1]
+    if len(movers) > 1:
+        return None
+    mover = movers[0] if len(movers) == 1 else 0
+    best = None
+    unknown = False
+    for move in itertools.product(*node.legals):
+        edge = node.actions.get(move)
+        values = solved(edge.next, game) if edge is not None and edge.next in game['tree'] else None
+        if values is None:
+            unknown = True
+        elif values[mover] == 100:
+            return values
+        elif best is None or values[mover] > best[mover]:
+            best = values
+    if unknown:
+        return None
+    return best
+
+def solve(path, game):
+    """
+    MCTS-solver: walks path back up from its leaf marking each node prove can decide
+    as proven, and stops at the first it can't since those above depend on it. Nothing
+    is proved in a factored game's subgames, whose trees leave out the other subgames' moves
+    """
+    if 'excluded' in game:
+        return
+    for state, move in reversed(path):
+        if state not in game['tree']:
+            return
+        if solved(state, game) is None:
+            game['tree'][state].proven = prove(state, game)
+            if game['tree'][state].proven is None:
+                return
+
+def findscores(move, state, game):
+    """
+    Returns the score_count of joint move from state. States are the tree's keys, so
+    a position reached by different move orders is one node, and once that node has
+    been visited its score_count, which pools every path through it, is used in
+    place of the edge's own. Returns None if neither has been visited
+    """
+    actions = game['tree'][state].actions
+    edge = actions.get(move) if actions is not None else None
+    if edge is None:
+        return None
+    if edge.next is not None:
+        node = game['tree'].get(edge.next)
+        if node is not None and node.score_count is not None:
+            return node.score_count
+    return edge.score_count
+
+def select(state, game):
+    """
+    Decoupled UCT: each role independently picks its own move, one it hasn't tried
+    from here yet at random if there is any, otherwise the one with the best UCB1
+    value from the node's statistics for that role. The joint move is never looked
+    up among the product of all the roles' moves, which is never built. Where only
+    one role has a choice, its statistics come from turnstats so transpositions
+    share them, and it passes over moves solve knows don't win while others remain,
+    since the node can't be proved until they are
+    """
+    legals = treemoves(state, game)
+    node = game['tree'][state]
+    movers = [idx for idx in range(len(legals)) if len(legals[idx]) > 1]
+    fixed = {}
+    match = parent(game)
+    if 'ponder' in match and state == match['state']:
+        # only the opponents' replies to the move already sent are worth searching
+        idx, role_move = match['ponder']
+        fixed[idx] = role_move
+    joint_move = []
+    for idx in range(len(legals)):
+        if idx in fixed:
+            joint_move.append(fixed[idx])
+            continue
+        stats = node.stats[idx] if node.stats is not None else {}
+        if movers == [idx]:
+            stats = turnstats(idx, legals, state, game)
+        unvisited = [role_move for role_move in legals[idx] if role_move not in stats]
+        if len(unvisited) > 0:
+            joint_move.append(random.choice(unvisited))
+            continue
+        log_total = math.log(sum([stats[role_move][1] for role_move in legals[idx]]))
+        role_moves = legals[idx]
+        if movers == [idx] and 'excluded' not in game:
+            unsolved = [role_move for role_move in role_moves if movevalues(idx, role_move, legals, state, game) \
+              in (None, 100)]
+            if len(unsolved) > 0:
+                role_moves = unsolved
+        joint_move.append(max(role_moves, key = lambda role_move: \
+          float(stats[role_move][0]) / (100.0 * stats[role_move][1]) \
+          + UCT_CONSTANT * math.sqrt(log_total / stats[role_move][1])))
+    return tuple(joint_move)
 
-def depthcharge(state, game, timeout):
-    if findterminalp(state, game) or time.time() > timeout:
-        if 'values' not in game['tree'][state]:
-           findreward(findroles(game)[0], state, game)
-        return game['tree'][state]['values']
+def turnstats(idx, legals, state, game):
+    """
+    {move: [summed score, count]} for role idx when it is the only one with a choice
+    at state, taken from findscores, so each move's statistics pool every path into
+    the position it leads to
+    """
+    stats = {}
+    for role_move in legals[idx]:
+        score_count = findscores(tuple([role_move if other == idx else legals[other][0] \
+          for other in range(len(legals))]), state, game)
+        if score_count is not None:
+            stats[role_move] = [score_count[idx], score_count[-1]]
+    return stats
+
+def movevalues(idx, role_move, legals, state, game):
+    """
+    Role idx's value, if solve knows it, of the state role_move leads to when role idx
+    is the only one with a choice, else None
+    """
+    edge = game['tree'][state].actions.get(tuple([role_move if other == idx else legals[other][0] \
+      for other in range(len(legals))]))
+    if edge is None or edge.next not in game['tree']:
+        return None
+    values = solved(edge.next, game)
+    return values[idx] if values is not None else None
+
+def treemoves(state, game):
+    """
+    The legal move ids per role which the search may pick from state: all of them,
+    or in a subgame's tree those not belonging to another subgame, unless more than
+    one role has a choice, since the exclusion would tie them all to one subgame.
+    None if a role has none left, so the subgame is over even though the game isn't
+    """
+    legals = findmoves(state, game)
+    if 'excluded' not in game or len([role_moves for role_moves in legals if len(role_moves) > 1]) > 1:
+        return legals
+    legals = tuple([tuple([role_move for role_move in role_moves if role_move not in game['excluded']]) \
+      for role_moves in legals])
+    if min([len(role_moves) for role_moves in legals]) == 0:
+        return None
+    return legals
+
+def treepolicy(state, game):
+    """
+    Walks down the tree from state with select() until it reaches a terminal or proven
+    state or a joint move which hasn't been tried, which gets expanded. A joint move leading
+    to a position already visited by another path counts as tried.
+    Returns the path of (state, joint move) edges ending with (leaf, None),
+    and the leaf to depthcharge from
+    """
+    path = []
+    while solved(state, game) is None and treemoves(state, game) is not None:
+        move = select(state, game)
+        path.append((state, move))
+        expanded = findscores(move, state, game) is not None
+        state = findnext(move, state, game)
+        if not expanded:
+            break
+    path.append((state, None))
+    return path, state
+
+def backpropagate(path, values, count, game):
+    """
+    Adds the summed values of count depthcharges to every node and edge along the path,
+    including the leaf node so transpositions into it see its statistics, and to each
+    role's statistics for its own part of the joint move taken out of each node.
+    Nodes pruned while a worker was busy with the path are skipped
+    """
+    if count == 0:
+        return
+    for state, move in path:
+        node = game['tree'].get(state)
+        if node is None:
+            continue
+        if node.score_count is None:
+            node.score_count = [0 for dummy in values] + [0]
+        counters = [node.score_count]
+        if move is not None:
+            if node.stats is None:
+                node.stats = [{} for dummy in values]
+            for idx in range(len(values)):
+                stat = node.stats[idx].setdefault(move[idx], [0, 0])
+                stat[0] += values[idx]
+                stat[1] += count
+        if move is not None and node.actions is not None and move in node.actions:
+            edge = node.actions[move]
+            if edge.score_count is None:
+                edge.score_count = [0 for dummy in values] + [0]
+            counters.append(edge.score_count)
+        for score_count in counters:
+            for idx in range(len(values)):
+                score_count[idx] += values[idx]
+            score_count[-1] += count
+
+def deadline(game, received, clock):
+    """
+    Returns when the search for a message which arrived at received must stop. The
+    reserve left for the answer is twice the worst recent time taken between the
+    deadline and the answer being written, at least MIN_RESERVE and at most half of
+    the clock. Until an answer has been timed, TIME_MARGIN of the clock is used
+    """
+    clock = float(clock)
+    if 'overrun' in game:
+        game['deadline'] = received + clock - min(0.5 * clock, max(MIN_RESERVE * clock, 2 * game['overrun']))
     else:
-        moves = findmoves(state, game)
-        if len(moves) == 0:
-            print(moves, state, findterminalp(state, game))
-        move = random.choice(moves)
-        next_state = findnext(move, state, game)
-        return depthcharge(next_state, game, timeout)
-
-def montecarlo(move, state, game, timeout):
-    next_state = findnext(move, state, game)
-    while time.time() < timeout:
-        values = depthcharge(next_state, game, timeout)
-        for idx in range(len(findroles(game))):
-            game['tree'][state]['actions'][move]['score_count'][idx] += values[idx]
-        game['tree'][state]['actions'][move]['score_count'][idx + 1] += 1
-    return game['tree'][state]['actions'][move]['score_count']
+        game['deadline'] = received + TIME_MARGIN * clock
+    return game['deadline']
+
+def answered(game):
+    "Times the answer just written against game['deadline'], letting earlier overruns fade"
+    overrun = max(0.0, time.time() - game['deadline'])
+    game['overrun'] = max(overrun, 0.9 * game.get('overrun', overrun))
+
+def searching(game, timeout):
+    "True until timeout, or until abort halts the game"
+    return time.time() < timeout and not game['halt'].is_set()
+
+def search(state, game, timeout):
+    """
+    Grows the tree from state until timeout with mcts, or poolmcts if there are workers.
+    A factored game has the trees of its subgames grown in turn for equal shares of the time
+    """
+    games = subgames(game)
+    for idx in range(len(games)):
+        share = time.time() + (timeout - time.time()) / (len(games) - idx)
+        if worker_pool is not None:
+            poolmcts(state, games[idx], share)
+        else:
+            mcts(state, games[idx], share)
+
+def mcts(state, game, timeout):
+    "Monte Carlo tree search from state until timeout or until state is solved"
+    while searching(game, timeout) and solved(state, game) is None:
+        iteration(state, game, timeout)
+
+def iteration(state, game, timeout):
+    "One walk down the tree from state, with PLAYOUT_BATCH depthcharges run here from the leaf"
+    path, leaf = treepolicy(state, game)
+    values, count = depthcharges(leaf, game, timeout, PLAYOUT_BATCH)
+    record(path, values, count, game)
+
+def record(path, values, count, game):
+    "Backpropagates the summed values of count depthcharges along path, proves what it can and prunes"
+    backpropagate(path, values, count, game)
+    solve(path, game)
+    prune(game)
+
+def poolmcts(state, game, timeout):
+    """
+    Same as mcts, but the depthcharges from each leaf are run by the worker pool, at
+    most two slices per worker at a time, and the search goes on here while none is
+    back. Slices still out at timeout stay in game['pending'] for the next call
+    """
+    pending = game.setdefault('pending', [])
+    while searching(game, timeout) and solved(state, game) is None:
+        if len(pending) < 2 * WORKERS:
+            path, leaf = treepolicy(state, game)
+            if solved(leaf, game) is not None:
+                values, count = depthcharges(leaf, game, timeout)
+                record(path, values, count, game)
+            else:
+                send(path, game['reasoner'].props.members(leaf), game)
+        elif collect(game) == 0:
+            iteration(state, game, timeout)
+
+def send(path, names, game, source = None):
+    """
+    Hands the worker pool DEPTHCHARGE_SLICE seconds of depthcharges from the state whose
+    base propositions are names, whose result is backpropagated along path by collect.
+    Leaves are sent by name since each worker's reasoner interns its own ids
+    """
+    game['pending'].append((path, names, worker_pool.apply_async(worker_montecarlo,
+      (game['worker_key'], names, time.time() + DEPTHCHARGE_SLICE, live_keys(), source))))
+
+def collect(game, drop = False):
+    """
+    Records the slices in game['pending'] which have come back, sending one again with
+    the reasoner if its worker hadn't got the match, and with drop forgets the rest.
+    Returns how many came back
+    """
+    pending = game.get('pending', [])
+    returned = [sent for sent in pending if sent[2].ready()]
+    for sent in returned:
+        pending.remove(sent)
+        path, names, result = sent
+        if result.get() is None:
+            if not drop:
+                send(path, names, game, game['worker_source'])
+            continue
+        values, count, worker_stats = result.get()
+        if worker_stats is not None and 'stats' in game:
+            merge_stats(game['stats'], worker_stats)
+        record(path, values, count, game)
+    if drop:
+        del pending[:]
+    return len(returned)
+
+def rolestats(idx, state, game):
+    """
+    Returns {move: [summed score, count]} for each legal move of role idx, [0, 0] if it
+    hasn't been tried, summed over the subgames' trees if the game is factored.
+    If no other role has a choice they come from turnstats, as in select
+    """
+    legals = findmoves(state, game)
+    stats = dict([(role_move, [0, 0]) for role_move in legals[idx]])
+    alone = [other for other in range(len(legals)) if len(legals[other]) > 1] == [idx]
+    for subgame in subgames(game):
+        node = subgame['tree'].get(state)
+        if node is not None and node.stats is not None:
+            role_stats = turnstats(idx, legals, state, subgame) if alone else node.stats[idx]
+            for role_move, stat in role_stats.items():
+                stats[role_move][0] += stat[0]
+                stats[role_move][1] += stat[1]
+    return stats
+
+def visits(state, game):
+    "The depthcharges through state, in all the subgames' trees if the game is factored"
+    nodes = [subgame['tree'].get(state) for subgame in subgames(game)]
+    return sum([node.score_count[-1] for node in nodes if node is not None and node.score_count is not None])
+
+def average(stat):
+    return float(stat[0]) / stat[1] if stat[1] > 0 else -1.0
+
+def decided(idx, state, game, timeout, rate):
+    """
+    True if role idx has only one move, or its move with the best average also has
+    more depthcharges than any other could catch up with before timeout, even if
+    all of the rate per second still to come went to the runner up
+    """
+    stats = rolestats(idx, state, game)
+    if len(stats) == 1:
+        return True
+    best = max(sorted(stats), key = lambda role_move: average(stats[role_move]))
+    counts = sorted([stats[role_move][1] for role_move in stats], reverse = True)
+    return stats[best][1] == counts[0] and counts[0] - counts[1] > rate * (timeout - time.time())
+
+def solution(idx, state, game):
+    "The move id of role idx leading to the values state is proven to have, or None if it isn't solved"
+    proven = solved(state, game)
+    if proven is None:
+        return None
+    for move, edge in sorted(game['tree'][state].actions.items()):
+        if edge.next in game['tree'] and solved(edge.next, game) == proven:
+            return move[idx]
+    return None
 
 def bestmove(role, state, game, timeout):
+    """
+    Searches and returns the move id for role with the best average score over all the
+    joint moves containing it, in all the subgames' trees if the game is factored.
+    If solve has proved the state, the move best play calls for is returned at once.
+    When pondering, the search goes on after the answer anyway, so it is cut short once
+    the move is decided, judged every DECIDE_INTERVAL by the depthcharges per second so far.
+    Worker slices still out when it answers are dropped. With -i the search is logged by log_move
+    """
     idx = findroles(game).index(role)
-    actions = findmoves(state, game)
-    move = random.choice(actions)
-    average_score = 0.0
-    time_per_move = (timeout - time.time())/float(len(actions))
-    for count in range(len(actions)):
-        if 'score_count' not in game['tree'][state]['actions'][actions[count]]:
-            game['tree'][state]['actions'][actions[count]]['score_count'] = [0 for dummy in findroles(game)] + [1]
-        timelimit = timeout - time_per_move*(len(actions) - count - 1)
-        scores = montecarlo(actions[count], state, game, timelimit)
-        estimated_utility = float(scores[idx])/float(scores[-1])
-        if estimated_utility > average_score:
-            average_score = estimated_utility
-            move = actions[count]
-    return move[idx]
+    started = time.time()
+    first_count = visits(state, game)
+    while searching(game, timeout) and solved(state, game) is None:
+        search(state, game, min(timeout, time.time() + DECIDE_INTERVAL))
+        if PONDER:
+            rate = (visits(state, game) - first_count) / (time.time() - started)
+            if decided(idx, state, game, timeout, rate):
+                break
+    for subgame in subgames(game):
+        collect(subgame, drop = True)
+    move = solution(idx, state, game)
+    if move is None:
+        stats = rolestats(idx, state, game)
+        move = max(sorted(stats), key = lambda role_move: average(stats[role_move]))
+    if 'stats' in game:
+        log_move(game, state, move, started)
+    return move
+
+##############################################################################
+# Factoring into independent subgames, turned on with -f
+
+def factor_game(game):
+    """
+    Looks for independent subgames with PropnetReasoner.factors and, if there is more
+    than one, gives each a game of its own in game['subgames'] whose tree of whole
+    states leaves out the other subgames' moves
+    """
+    if len([role_moves for role_moves in findmoves(game['state'], game) if len(role_moves) > 1]) > 1:
+        return
+    if isinstance(game['reasoner'], PropnetReasoner):
+        found = game['reasoner'].factors()
+    else:
+        found = PropnetReasoner(game['rules']).factors()
+    if len(found) < 2:
+        return
+    print("Found %d independent subgames" % len(found))
+    moves = [set([game['reasoner'].moves.intern(name) for name in names]) for props, names in found]
+    game['subgames'] = []
+    for idx in range(len(found)):
+        subgame = {'game_id': game['game_id'], 'worker_key': game['worker_key'],
+          'worker_source': game.get('worker_source'), 'rules': game['rules'],
+          'reasoner': game['reasoner'], 'roles': findroles(game), 'halt': game['halt'], 'history': game['history'],
+          'parent': game, 'tree': {}, 'clock': 0, 'parts': len(found),
+          'excluded': set().union(*[moves[other] for other in range(len(found)) if other != idx])}
+        for state, node in game['tree'].items():
+            merge_node(subgame['tree'], state, node, subgame['excluded'])
+        if 'stats' in game:
+            subgame['stats'] = game['stats']
+        game['subgames'].append(subgame)
+    # the subgames have the cached nodes now, and the game's own tree only follows the moves played
+    game['tree'] = {}
+
+def subgames(game):
+    "The games whose trees are searched, the subgames of a factored game or else the game itself"
+    return game.get('subgames', [game])
+
+def parent(game):
+    "The match a subgame belongs to, which holds the current state and the move being pondered, or else the game itself"
+    return game.get('parent', game)
+
+def merge_node(tree, state, node, excluded = ()):
+    """
+    Adds what node knows of state, leaving out the statistics and edges of excluded
+    moves, to tree[state], which is a new Node the first time so node is unchanged.
+    Summing the score_counts and per role statistics makes one node of the nodes of
+    a state in several subgames' trees, as rolestats sums them
+    """
+    merged = tree.get(state)
+    if merged is None:
+        merged = tree[state] = Node()
+    for slot in ('terminal', 'values', 'estimate', 'proven', 'legals'):
+        if getattr(merged, slot) is None:
+            setattr(merged, slot, getattr(node, slot))
+    merged.score_count = add_counts(merged.score_count, node.score_count)
+    if node.stats is not None:
+        if merged.stats is None:
+            merged.stats = [{} for dummy in node.stats]
+        for idx in range(len(node.stats)):
+            for role_move, stat in node.stats[idx].items():
+                if role_move not in excluded:
+                    merged.stats[idx][role_move] = add_counts(merged.stats[idx].get(role_move), stat)
+    if node.actions is not None:
+        if merged.actions is None:
+            merged.actions = {}
+        for move, edge in node.actions.items():
+            if len(excluded) > 0 and len([role_move for role_move in move if role_move in excluded]) > 0:
+                continue
+            if move not in merged.actions:
+                merged.actions[move] = Edge()
+                merged.actions[move].next = edge.next
+            merged.actions[move].score_count = add_counts(merged.actions[move].score_count, edge.score_count)
+
+def add_counts(total, counts):
+    "The sum of two score_counts or [score, count] lists, either of which may be None"
+    if counts is None:
+        return total
+    if total is None:
+        return list(counts)
+    return [total[idx] + counts[idx] for idx in range(len(counts))]
+
+def merged_tree(game):
+    """
+    game['tree'], or for a factored game a new tree merging it with the subgames'
+    trees, which hold all the search, for the export and the disk cache
+    """
+    if 'subgames' not in game:
+        return game['tree']
+    tree = {}
+    for searched in [game] + game['subgames']:
+        for state, node in searched['tree'].items():
+            merge_node(tree, state, node)
+    return tree
+
+##############################################################################
+# Pondering, turned off with -o
+
+def ponder(game):
+    """
+    Starts a thread which keeps searching from game['state'] until stop_pondering is
+    called. play sets game['ponder'] to the role index and move just sent, and the
+    root is then limited to joint moves containing it
+    """
+    game['ponder_stop'] = threading.Event()
+    game['ponder_thread'] = threading.Thread(target = ponder_search, args = (game,))
+    game['ponder_thread'].daemon = True
+    game['ponder_thread'].start()
+
+def ponder_search(game):
+    "Searches in PONDER_SLICE second slices so stop_pondering never waits long, and idles once the state is solved"
+    while not game['ponder_stop'].is_set():
+        if solved(game['state'], game) is not None:
+            game['ponder_stop'].wait(PONDER_SLICE)
+            continue
+        search(game['state'], game, time.time() + PONDER_SLICE)
+
+def stop_pondering(game):
+    "Waits for the pondering thread, if any, so the caller has the tree and reasoner to itself"
+    if 'ponder_thread' in game:
+        game['ponder_stop'].set()
+        game['ponder_thread'].join()
+        del game['ponder_thread']
+    if 'ponder' in game:
+        del game['ponder']
+
+##############################################################################
+# Cache of games played before, turned on with -c
+
+def rules_hash(rules):
+    "Names the rules for cache files and workers"
+    return hashlib.sha1(repr(rules)).hexdigest()
+
+def cache_path(rules):
+    "Cache files are named by reasoner and a hash of the parsed rules"
+    return os.path.join(CACHE_DIR, REASONER + '-' + rules_hash(rules) + '.pickle')
+
+def load_cache(rules):
+    """
+    Returns the dictionary saved by save_cache the last time these rules were played,
+    or None. The file is mapped into memory rather than read into a string first
+    """
+    if CACHE_DIR == False or not os.path.exists(cache_path(rules)):
+        return None
+    with open(cache_path(rules), 'rb') as cache_file:
+        data = mmap.mmap(cache_file.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            cache = cPickle.load(data)
+        except Exception as error:
+            print("Ignoring cache " + cache_path(rules) + ": " + str(error))
+            return None
+        finally:
+            data.close()
+    if cache.get('format') != CACHE_FORMAT:
+        print("Ignoring cache " + cache_path(rules) + " saved in an older format")
+        return None
+    return cache
+
+def cached_reasoner(rules, cache):
+    """
+    The reasoner saved in cache, already compiled, or a new one whose symbol tables
+    are given the cached names first so the cached states and moves keep their ids
+    """
+    if cache is None:
+        return new_reasoner(rules)
+    if cache['reasoner'] is not None:
+        return cache['reasoner']
+    reasoner = new_reasoner(rules)
+    for name in cache['props']:
+        reasoner.props.intern(name)
+    for name in cache['moves']:
+        reasoner.moves.intern(name)
+    return reasoner
+
+def cached_tree(reasoner, cache):
+    "The nodes saved in cache, if its ids agree with reasoner's symbol tables"
+    if cache is None or reasoner.props.names[:len(cache['props'])] != cache['props'] \
+      or reasoner.moves.names[:len(cache['moves'])] != cache['moves']:
+        return {}
+    return cache['tree']
+
+def keep_book(game, tree, states):
+    """
+    Adds the nodes of states in tree, which reroot is about to drop from it, to
+    game['book'], merging those of a state already there, which the subgames' trees
+    of a factored game may each have, and keeps only the CACHE_NODES most visited
+    of them there for save_cache
+    """
+    book = game.setdefault('book', {})
+    for state in states:
+        if state in book:
+            merge_node(book, state, tree[state])
+        else:
+            book[state] = tree[state]
+    if len(book) > CACHE_NODES:
+        visits = lambda state: book[state].score_count[-1] if book[state].score_count is not None else 0
+        for state in sorted(book, key = visits)[:len(book) - CACHE_NODES]:
+            del book[state]
+
+def save_cache(game):
+    """
+    Saves the reasoner (unless it's a Prolog session), its symbol tables and the
+    CACHE_NODES most visited nodes of the tree, merged with the subgames' if the game
+    is factored, and of the nodes rerooting dropped, which serve as an opening book
+    the next time the same rules are played
+    """
+    tree = dict(game.get('book', {}))
+    for state, node in merged_tree(game).items():
+        if state in tree:
+            merge_node(tree, state, node)
+        else:
+            tree[state] = node
+    visits = lambda state: tree[state].score_count[-1] if tree[state].score_count is not None else 0
+    nodes = {}
+    for state in sorted(tree, key = visits, reverse = True)[:CACHE_NODES]:
+        nodes[state] = tree[state]
+        nodes[state].used = 0
+    reasoner = game['reasoner']
+    cache = {'format': CACHE_FORMAT, 'props': reasoner.props.names, 'moves': reasoner.moves.names,
+      'tree': nodes,
+      'reasoner': None if isinstance(reasoner, PrologReasoner) else reasoner}
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError:
+        # already there, or just made by another match stopping
+        if not os.path.isdir(CACHE_DIR):
+            raise
+    # a temporary file of its own, since matches of the same rules may stop at once
+    handle, temp_path = tempfile.mkstemp(suffix = '.tmp', dir = CACHE_DIR)
+    with os.fdopen(handle, 'wb') as cache_file:
+        cPickle.dump(cache, cache_file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, cache_path(game['rules']))
+
+##############################################################################
+# Instrumentation, turned on with -i
+
+def new_stats():
+    """
+    The counters kept in game['stats'] between answers: calls and seconds per reasoner
+    method, terminal, legal, next and goal lookups answered from game['tree'] (hits)
+    or asked of the reasoner (misses), and the depthcharges run along with their summed plies
+    """
+    return {'queries': {}, 'hits': 0, 'misses': 0, 'depthcharges': 0, 'plies': 0}
+
+def ask(game, query, *args):
+    "Returns game['reasoner'].query(*args), counted and timed if the game has stats"
+    if 'stats' not in game:
+        return getattr(game['reasoner'], query)(*args)
+    started = time.time()
+    result = getattr(game['reasoner'], query)(*args)
+    stat = game['stats']['queries'].setdefault(query, [0, 0.0])
+    stat[0] += 1
+    stat[1] += time.time() - started
+    return result
+
+def count_lookup(game, hit):
+    "Counts a lookup answered from the tree, or if not hit one the reasoner is asked, if the game has stats"
+    if 'stats' in game:
+        game['stats']['hits' if hit else 'misses'] += 1
+
+def merge_stats(stats, other):
+    "Adds the counters of other, sent back by a worker, to stats"
+    for query, (calls, seconds) in other['queries'].items():
+        stat = stats['queries'].setdefault(query, [0, 0.0])
+        stat[0] += calls
+        stat[1] += seconds
+    for name in ('hits', 'misses', 'depthcharges', 'plies'):
+        stats[name] += other[name]
+
+def log_move(game, state, move, started):
+    """
+    Prints a JSON line describing the search behind move, which began at started,
+    keeps it in game['log'] for GET /stats, and starts game['stats'] afresh. The
+    counts include any pondering since the previous answer
+    """
+    stats = game['stats']
+    record = {'game_id': game['game_id'], 'ply': len(game['history']) - 1,
+      'move': game['reasoner'].moves.names[move], 'seconds': round(time.time() - started, 3),
+      'visits': visits(state, game), 'solved': solved(state, game) is not None,
+      'depthcharges': stats['depthcharges'],
+      'nodes': sum([len(subgame['tree']) for subgame in subgames(game)]),
+      'average_depth': round(float(stats['plies']) / stats['depthcharges'], 1) if stats['depthcharges'] > 0 else 0,
+      'hits': stats['hits'], 'misses': stats['misses'],
+      'queries': dict([(query, {'calls': calls, 'seconds': round(seconds, 3)}) \
+        for query, (calls, seconds) in stats['queries'].items()])}
+    game['log'].append(record)
+    # reset in place since the subgames of a factored game share it
+    stats.clear()
+    stats.update(new_stats())
+    print(json.dumps(record, sort_keys = True))
+
+def stats_page():
+    "The log of every match being played, by game_id, as JSON"
+    with matches_lock:
+        games = list(matches.values())
+    return json.dumps(dict([(game['game_id'], game.get('log', [])) for game in games]), sort_keys = True)
+
+##############################################################################
+# Worker pool, started with -w and shared by all matches
+
+def worker_init():
+    "Workers ignore ^C, which the server handles"
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def live_keys():
+    "The worker_key of each match being played, which are the matches workers keep"
+    with matches_lock:
+        return [game['worker_key'] for game in matches.values()]
+
+def worker_source(game):
+    """
+    What workers get their reasoner for the match from: the match's own pickled, so
+    they needn't compile it again, or the rules if it is a Prolog session
+    """
+    if isinstance(game['reasoner'], PrologReasoner):
+        return game['rules']
+    return cPickle.dumps(game['reasoner'], cPickle.HIGHEST_PROTOCOL)
+
+def worker_load(key, source, live):
+    """
+    Runs in a worker, setting up its reasoner and tree for the match known as key
+    in its copy of matches from source, made by worker_source, unless it has them
+    already, and closing the matches no longer in live. start sends one to each
+    worker once the match's own reasoner is ready
+    """
+    for other_key in list(matches):
+        if other_key not in live:
+            matches.pop(other_key)['reasoner'].close()
+    if key not in matches:
+        if isinstance(source, str):
+            reasoner = cPickle.loads(source)
+        else:
+            reasoner = cached_reasoner(source, load_cache(source))
+        matches[key] = {'tree': {}, 'clock': 0, 'game_id': key, 'reasoner': reasoner}
+
+def worker_montecarlo(key, names, timeout, live, source = None):
+    """
+    Runs in a worker, returns the summed values and number of depthcharges from
+    the state whose base propositions are names, and with -i the worker's stats for
+    them. The match is looked up by its worker_key, and if the worker hasn't got
+    it, it is set up by worker_load from source, or None returned if that wasn't sent
+    """
+    if key not in matches and source is None:
+        return None
+    worker_load(key, source, live)
+    game = matches[key]
+    if INSTRUMENT:
+        game['stats'] = new_stats()
+    state = game['reasoner'].props.bits(names)
+    values = [0 for dummy in findroles(game)]
+    count = 0
+    while time.time() < timeout:
+        new_values, new_count = depthcharges(state, game, timeout, PLAYOUT_BATCH)
+        values = [values[idx] + new_values[idx] for idx in range(len(values))]
+        count += new_count
+        prune(game)
+    return (values, count, game.get('stats'))
+
+##############################################################################
+
+def findnode(state, game):
+    "Returns the tree node for state, creating it if need be, and stamps it for LRU eviction"
+    node = game['tree'].get(state)
+    if node is None:
+        node = game['tree'][state] = Node()
+    game['clock'] += 1
+    node.used = game['clock']
+    return node
+
+def prune(game):
+    """
+    Keeps game['tree'] within its share of MAX_NODES by dropping the least recently
+    used nodes, or the least visited if EVICTION is 'visits', down to PRUNE_TO of it.
+    The states played so far and the children of the current state are kept
+    """
+    tree = game['tree']
+    budget = MAX_NODES // max(1, len(matches)) // game.get('parts', 1)
+    if MAX_NODES == 0 or len(tree) <= budget:
+        return
+    keep = set(game.get('history', []))
+    current = parent(game).get('state')
+    if current in tree and tree[current].actions is not None:
+        for edge in tree[current].actions.values():
+            if edge.next is not None:
+                keep.add(edge.next)
+    if EVICTION == 'visits':
+        rank = lambda state: (tree[state].score_count[-1] if tree[state].score_count is not None else 0,
+          tree[state].used)
+    else:
+        rank = lambda state: tree[state].used
+    candidates = sorted([state for state in tree if state not in keep], key = rank)
+    for state in candidates[:len(tree) - int(PRUNE_TO * budget)]:
+        del tree[state]
+
+def reroot(game):
+    """
+    Drops the nodes which can no longer be reached from game['state'], or from the
+    replies to the move just sent when pondering, along with those of any subgames
+    """
+    # the export at stop starts from the initial state
+    if DOT_FILE_NAME != False:
+        return
+    tree = game['tree']
+    match = parent(game)
+    root = tree.get(match['state'])
+    stack = [match['state']]
+    if 'ponder' in match and root is not None and root.actions is not None:
+        idx, role_move = match['ponder']
+        stack = [edge.next for move, edge in root.actions.items() if move[idx] == role_move]
+    reachable = set()
+    while len(stack) > 0:
+        state = stack.pop()
+        if state in reachable or state not in tree:
+            continue
+        reachable.add(state)
+        if tree[state].actions is not None:
+            stack.extend([edge.next for edge in tree[state].actions.values() if edge.next is not None])
+    reachable.update(game['history'])
+    dropped = [state for state in tree if state not in reachable]
+    if CACHE_DIR != False:
+        keep_book(match, tree, dropped)
+    for state in dropped:
+        del tree[state]
+    for subgame in game.get('subgames', []):
+        reroot(subgame)
 
 def findroles(game):
     if 'roles' not in game:
-        game['roles'] = [rule[1] for rule in game['rules'] if rule[0] == 'role']
+        game['roles'] = game['reasoner'].roles()
     return game['roles']
 
 def findinits(game):
-    ret_lst = []
-    for rule in game['rules']:
-        if rule[0] == 'init':
-            if isinstance(rule[1], str):
-                ret_lst.append(rule[1])
-            else:
-                ret_lst.append(rule[1][0] + '(' + ",".join(rule[1][1:]) + ')')
-    return tuple(sorted(ret_lst))
+    return ask(game, 'inits')
 
 def findmoves(state, game):
     """
-    state is a tuple of bases
+    state is an integer with a bit set for each true base proposition
     game is a global dictionary
-    output is a list of tuples of the Cartesian product of all players' legal moves
-    which double as the edges of the game tree
+    output is a tuple with a tuple of legal move ids per role, in the order of
+    findroles. Each reasoner lists a role's moves in a fixed order, so no sort is
+    needed here. Joint moves are made from these as they are tried
     """
-    if state not in game['tree']:
-        game['tree'][state] = {}
-    if findterminalp(state, game):
+    node = findnode(state, game)
+    # read straight from the node once known, so only the legal lookup is counted
+    if node.terminal is None:
+        findterminalp(state, game)
+    if node.terminal:
         return None
-    if 'actions' not in game['tree'][state]:
-        game['tree'][state]['actions'] = {}
-        roles = findroles(game)
-        ret_lst = [set() for dummy in roles]
-        prolog = game['prolog_rules']
-        for prop in state:
-            prolog += 'true(' + prop + '). '
-        prolog += 'main :- findall([R,M], legal(R,M), L), write(L), halt.'
-        proc = subprocess.Popen(PROLOG, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
-        legals = str2list(proc.communicate(input = prolog)[0])
-        for legal in legals:
-            idx = legal.index(',')
-            ret_lst[roles.index(legal[:idx])].add(legal[idx + 1:])
-        ret_lst = [sorted(list(move_set)) for move_set in ret_lst]
-        edges = tuple(itertools.product(*ret_lst))
-        for edge in edges:
-            game['tree'][state]['actions'][edge] = {}
-    return sorted(game['tree'][state]['actions'].keys())
+    count_lookup(game, node.legals is not None)
+    if node.legals is None:
+        node.legals = tuple([tuple(role_moves) for role_moves in ask(game, 'legal', state)])
+    return node.legals
 
 def findlegals(role, state, game):
     """
-    This filters out other player moves to only include those of the given role
+    The legal move ids of the given role
     """
     if findterminalp(state, game):
         return None
-    ret_set = set()
-    idx = findroles(game).index(role)
-    for move in findmoves(state, game):
-        ret_set.add(move[idx])
-    return sorted(ret_set)
+    return list(findmoves(state, game)[findroles(game).index(role)])
+
+def findedge(moves, state, game):
+    "Returns the Edge for joint move moves out of state, adding it the first time it's tried"
+    node = findnode(state, game)
+    if node.actions is None:
+        node.actions = {}
+    edge = node.actions.get(moves)
+    if edge is None:
+        edge = node.actions[moves] = Edge()
+    return edge
 
 def findnext(moves, state, game):
     """
-    moves is a tuple like ('move(4,1,3,1)', 'noop')
-    state is a tuple of bases
+    moves is a tuple of move ids like the names ('move(4,1,3,1)', 'noop')
+    state is an integer with a bit set for each true base proposition
     game is a global dictionary
     """
-    if state not in game['tree']:
-        game['tree'][state] = {}
-    if 'actions' not in game['tree'][state]:
-        findmoves(state, game)
-    # bug here that causes crashes
-    if 'next' not in game['tree'][state]['actions'][moves]:
-        roles = findroles(game)
-        prolog = game['prolog_rules']
-        for idx in range(len(moves)):
-            if moves[idx] != 'noop':
-                prolog += 'does(' + roles[idx] + ',' + moves[idx] + '). '
-        for prop in state:
-            prolog += 'true(' + prop + '). '
-        prolog += 'main :- findall([B], next(B), L), write(L), halt. '
-        proc = subprocess.Popen(PROLOG, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
-        game['tree'][state]['actions'][moves]['next'] = str2list(proc.communicate(input = prolog)[0])
-    return game['tree'][state]['actions'][moves]['next']
+    edge = findedge(moves, state, game)
+    if edge.next is None:
+        prefetch([(moves, state)], game)
+    else:
+        count_lookup(game, True)
+    return edge.next
+
+def prefetch(steps, game):
+    """
+    steps is a list of (moves, state) edges
+    Fills in the next state of every edge not already known, and the terminal status
+    and legal moves or goals of that next state, with one reasoner.advances call
+    """
+    todo = []
+    edges = []
+    for moves, state in steps:
+        edge = findedge(moves, state, game)
+        count_lookup(game, edge.next is not None)
+        if edge.next is None and edge not in edges:
+            todo.append((moves, state))
+            edges.append(edge)
+    if len(todo) == 0:
+        return
+    results = ask(game, 'advances', todo)
+    for idx in range(len(todo)):
+        next_state, status = results[idx]
+        edges[idx].next = next_state
+        if next_state not in game['tree'] or game['tree'][next_state].terminal is None:
+            store_status(next_state, status, game)
+
+def store_status(state, status, game):
+    """
+    status is the (terminal, legal, values) tuple returned by reasoner.status,
+    legal being None for terminal states and values None for non terminal ones
+    """
+    terminal, legal, values = status
+    node = findnode(state, game)
+    node.terminal = terminal
+    if terminal:
+        node.values = values
+    elif node.legals is None:
+        node.legals = tuple([tuple(role_moves) for role_moves in legal])
 
 def findreward(role, state, game):
     """
     Returns an integer, with 100 indicating victory and 0 maybe defeat or nothing
     """
-    if state not in game['tree']:
-        game['tree'][state] = {}
-    if 'values' not in game['tree'][state]:
-        roles = findroles(game)
-        prolog = game['prolog_rules']
-        for prop in state:
-            prolog += 'true(' + prop + '). '
-        prolog += 'main :- findall([Role, N], goal(Role, N), L), write(L), halt. '
-        proc = subprocess.Popen(PROLOG, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
-        rewards = str2list(proc.communicate(input = prolog)[0])
-        ret_lst = [0 for dummy in roles]
-        for reward in rewards:
-            idx = reward.index(',')
-            ret_lst[roles.index(reward[:idx])] = int(reward[idx + 1:])
-        game['tree'][state]['values'] = tuple(ret_lst)
-    return game['tree'][state]['values'][findroles(game).index(role)]
+    node = findnode(state, game)
+    count_lookup(game, node.values is not None)
+    if node.values is None:
+        node.values = ask(game, 'goal', state)
+    return node.values[findroles(game).index(role)]
 
 def findterminalp(state, game):
     """
     Boolean, true if terminal
     """
-    if state not in game['tree']:
-        game['tree'][state] = {}
-    if 'terminal' not in game['tree'][state]:
-        prolog = game['prolog_rules']
-        for prop in state:
-            prolog += 'true(' + prop + '). '
-        prolog += "end :- terminal, write('True'). "
-        prolog += "end :- \+terminal, write('False'). "
-        prolog += 'main :- end, halt. '
-        proc = subprocess.Popen(PROLOG, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
-        game['tree'][state]['terminal'] = (proc.communicate(input = prolog)[0] == 'True')            
-    return game['tree'][state]['terminal'] 
-      
+    node = findnode(state, game)
+    count_lookup(game, node.terminal is not None)
+    if node.terminal is None:
+        store_status(state, ask(game, 'status', state), game)
+    return node.terminal
+
 ##################################################################################
 # Helper functions for GGP protocol handlers
 
-def str2list(ret_str):
-    if ret_str.find('[') == -1:
-        return ret_str
-    nexts = ret_str[1:-1].split(']')
-    nexts = [(base[2:] if base[0:2] == ',[' else base[1:]) for base in nexts if len(base) > 0]
-    return tuple(sorted(set(nexts)))
-
 def rewrite_move(move):
     """
     Convert list to prolog string
     """
     if isinstance(move, str):
         return move
-    ret_lst = []
-    for item in move:
-        if isinstance(item, list):
-            ret_lst.append(item[0] + '(' + ",".join(item[1:]) + ')')
-        else:
-            ret_lst.append(item)
-    return tuple(ret_lst)
+    return tuple([term2str(to_term(item)) for item in move])
 
 def prolog_rules(rules):
     """
     Translate rules into prolog and return as a long string.
-    Specific "trues" and queries are later appended to this on a case
-    by case basis
+    The program ends with a query loop (PROLOG_LOOP) so that it only needs
+    to be consulted once per match by prolog_session
     """
     def rewrite(rule):
         "Recursive helper for nested s-expressions"
@@ -219,69 +1134,296 @@ def prolog_rules(rules):
                     rule_copy[idx] = rewrite(rule_copy[idx])
             return rewrite(rule_copy)
 
-    prolog = ':- set_prolog_flag(verbose, silent).\n'
-    prolog += ':- initialization(main).\n'
-    prolog += 'distinct(A, B) :- A \\= B.\n'
+    prolog = [':- set_prolog_flag(verbose, silent).\n']
+    prolog.append(':- initialization(ggp_main).\n')
+    prolog.append(':- dynamic(true/1).\n')
+    prolog.append(':- dynamic(does/2).\n')
+    prolog.append(':- dynamic(ggp_symbol/3).\n')
+    prolog.append(':- dynamic(ggp_count/2).\n')
+    prolog.append('distinct(A, B) :- A \\= B.\n')
     # prolog += 'or(A, B) :- (A ; B). '
+    tables, dynamic_tables = tabled(rules)
+    for name, arity in tables:
+        prolog.append(':- table ' + name + '/' + str(arity) + '.\n')
+    # tables which depend on true or does are cleared whenever those change
+    abolish = ['true']
+    for name, arity in dynamic_tables:
+        if arity > 0:
+            name += '(' + ', '.join(['_'] * arity) + ')'
+        abolish.append('abolish_table_subgoals(' + name + ')')
+    prolog.append('ggp_fresh :- ' + ', '.join(abolish) + '.\n')
+    role_names = [rule[1] for rule in rules if rule[0] == 'role']
+    for idx in range(len(role_names)):
+        prolog.append('ggp_role(' + role_names[idx] + ', ' + str(idx) + ').\n')
     for rule in rules:
         if rule[0] != '<=':
-            next_rule = rewrite(rule) + '.\n'
+            prolog.append(rewrite(rule) + '.\n')
         else:
-            next_rule = rewrite(rule[1]) + ' :- ' + ", ".join([rewrite(body) \
-              for body in rule[2:]]) + '.\n'
-        prolog += next_rule
-    return prolog
+            prolog.append(rewrite(rule[1]) + ' :- ' + ", ".join([rewrite(body) \
+              for body in rule[2:]]) + '.\n')
+    prolog.append(PROLOG_LOOP)
+    return ''.join(prolog)
 
-def game2dot(game_dict, filename):
+def tabled(rules):
+    """
+    Returns the (name, arity) of the recursive relations, and of those which depend
+    on true or does. prolog_rules tables them so left recursion terminates and
+    each answer is only worked out once per state
+    """
+    graph = {}
+    for rule in rules:
+        if rule[0] == '<=':
+            rule = to_term(rule)
+            deps = graph.setdefault(key(rule[1]), set())
+            for literal in rule[2:]:
+                dependencies(literal, deps)
+    dynamic = dynamic_keys(graph)
+    ret_lst = []
+    for component in strata(graph):
+        if len(component) > 1 or component[0] in graph.get(component[0], ()):
+            ret_lst.extend(component)
+    return sorted(ret_lst), sorted([head_key for head_key in ret_lst if head_key in dynamic])
+
+def prolog_session(prolog):
+    """
+    Start one Prolog process for the whole match. The program is followed by
+    end_of_file so the consult stops there, and the same pipe is then used by
+    the ggp_serve loop to read one ggp_query term per line
+    """
+    proc = subprocess.Popen(PROLOG, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+    proc.stdin.write(prolog + 'end_of_file.\n')
+    proc.stdin.flush()
+    ready = proc.stdout.readline().strip()
+    if ready != 'ready':
+        raise RuntimeError('Prolog did not start: ' + ready)
+    return proc
+
+class PrologReasoner(object):
+    """
+    The reasoner interface used by findroles, findinits, findmoves, findnext,
+    findreward and findterminalp. gdl_interpreter.PythonReasoner implements the same methods.
+    Base propositions like 'cell(1,1,x)' and moves are interned in self.props and self.moves,
+    and states are integers with a bit set for each true base proposition
     """
-    Creates a graphviz dot file (http://www.graphviz.org/content/dot-language)
+
+    def __init__(self, rules):
+        self.role_names = [rule[1] for rule in rules if rule[0] == 'role']
+        self.props = Symbols()
+        self.moves = Symbols()
+        # ids in self.props and self.moves by Prolog's numbering
+        self.prop_ids = []
+        self.move_ids = []
+        started = time.time()
+        program = prolog_rules(rules)
+        translated = time.time()
+        self.prolog = prolog_session(program)
+        print("Rules translated in %.3f seconds and consulted in %.3f seconds" \
+          % (translated - started, time.time() - translated))
+
+    def write_query(self, query, state, moves = ()):
+        """
+        query is one of 'init', 'legal', 'next', 'goal', 'terminal', 'status' or 'advance'
+        The true and does facts are replaced inside the running Prolog process
+        """
+        names = [self.moves.names[move] for move in moves]
+        does = ['does(' + self.role_names[idx] + ',' + names[idx] + ')' for idx in range(len(names)) \
+          if names[idx] != 'noop']
+        self.prolog.stdin.write('ggp_query([' + ','.join(self.props.members(state)) + '], [' + ','.join(does) \
+          + '], ' + query + ').\n')
+
+    def query(self, query, state, moves = ()):
+        "Returns the answer as the list of numbers written by ggp_reply"
+        self.write_query(query, state, moves)
+        self.prolog.stdin.flush()
+        return self.read_numbers()
+
+    def read_numbers(self):
+        """
+        Answers are lines of numbers: role indices, goal values and Prolog's own
+        numbering of propositions and moves. The first time Prolog numbers a term
+        it writes 'p term' or 'm term' on a line of its own first, which is interned
+        here, so no answer is parsed as text or sorted
+        """
+        while True:
+            line = self.prolog.stdout.readline().rstrip('\n')
+            if line.startswith('p '):
+                self.prop_ids.append(self.props.intern(line[2:]))
+            elif line.startswith('m '):
+                self.move_ids.append(self.moves.intern(line[2:]))
+            else:
+                return [int(number) for number in line.split()]
+
+    def parse_state(self, numbers):
+        ret_int = 0
+        for number in numbers:
+            ret_int |= 1 << self.prop_ids[number]
+        return ret_int
+
+    def parse_legal(self, numbers):
+        "numbers are pairs of role index and move"
+        ret_lst = [[] for dummy in self.role_names]
+        for idx in range(0, len(numbers), 2):
+            ret_lst[numbers[idx]].append(self.move_ids[numbers[idx + 1]])
+        return ret_lst
+
+    def parse_goal(self, numbers):
+        "numbers are pairs of role index and value"
+        ret_lst = [0 for dummy in self.role_names]
+        for idx in range(0, len(numbers), 2):
+            ret_lst[numbers[idx]] = numbers[idx + 1]
+        return tuple(ret_lst)
+
+    def parse_status(self, numbers):
+        "The first number is 1 if terminal, followed by the goals, or 0 followed by the legal moves"
+        if numbers[0] == 1:
+            return (True, None, self.parse_goal(numbers[1:]))
+        return (False, self.parse_legal(numbers[1:]), None)
+
+    def roles(self):
+        return list(self.role_names)
+
+    def inits(self):
+        return self.parse_state(self.query('init', 0))
+
+    def legal(self, state):
+        "Returns a list of legal moves for each role"
+        return self.parse_legal(self.query('legal', state))
+
+    def next(self, moves, state):
+        return self.parse_state(self.query('next', state, moves))
+
+    def goal(self, state):
+        return self.parse_goal(self.query('goal', state))
+
+    def terminal(self, state):
+        return self.query('terminal', state) == [1]
+
+    def status(self, state):
+        "(terminal, legal, values) in one round trip, legal None if terminal, values None if not"
+        return self.parse_status(self.query('status', state))
+
+    def advances(self, steps):
+        """
+        steps is a list of (moves, state)
+        Returns a list of (next state, status of next state). All the queries are written
+        before any answer is read, so the whole batch costs one round trip
+        """
+        for moves, state in steps:
+            self.write_query('advance', state, moves)
+        self.prolog.stdin.flush()
+        ret_lst = []
+        for dummy in steps:
+            next_state = self.parse_state(self.read_numbers())
+            ret_lst.append((next_state, self.parse_status(self.read_numbers())))
+        return ret_lst
+
+    def close(self):
+        "Closing stdin makes ggp_serve read end_of_file and halt"
+        self.prolog.stdin.close()
+        self.prolog.wait()
+
+def new_reasoner(rules):
+    "REASONER is set with -r on the command line"
+    if REASONER == 'propnet':
+        return PropnetReasoner(rules)
+    if REASONER == 'python':
+        return PythonReasoner(rules)
+    return PrologReasoner(rules)
+
+##########################################################
+# Game tree export, turned on with -g
+
+def export_nodes(game):
+    """
+    Generator of the nodes of the tree in breadth first order from the initial state,
+    as (number, depth, state, node, edges) where edges is a list of (joint move, Edge,
+    number of the node it leads to). Only edges with at least EXPORT_VISITS depthcharges
+    are followed, at most the EXPORT_TOP most visited out of each node (0 for all), and
+    nodes are not expanded beyond EXPORT_DEPTH plies (0 for no limit). A node reached by
+    more than one path is numbered and given once, so nothing is held but the queue.
+    A factored game's subgame trees are merged first
+    """
+    tree = merged_tree(game)
+    visits = lambda edge: edge.score_count[-1] if edge.score_count is not None else 0
+    root = game['history'][0]
+    numbers = {root: 0}
+    queue = collections.deque([(root, 0)])
+    while len(queue) > 0:
+        state, depth = queue.popleft()
+        node = tree[state]
+        edges = []
+        if not node.terminal and node.actions is not None and (EXPORT_DEPTH == 0 or depth < EXPORT_DEPTH):
+            # mcts only expands the edges it has tried
+            tried = [(move, edge) for move, edge in node.actions.items() \
+              if edge.next in tree and visits(edge) >= max(1, EXPORT_VISITS)]
+            tried.sort(key = lambda move_edge: (-visits(move_edge[1]), move_edge[0]))
+            for move, edge in tried[:EXPORT_TOP or len(tried)]:
+                if edge.next not in numbers:
+                    numbers[edge.next] = len(numbers)
+                    queue.append((edge.next, depth + 1))
+                edges.append((move, edge, numbers[edge.next]))
+        yield numbers[state], depth, state, node, edges
+
+def write_dot(game, export_file):
+    """
+    Writes a graphviz dot file (http://www.graphviz.org/content/dot-language)
     which can be converted into an svg file to view in a browser by calling
     dot -Tsvg -ofilename.svg filename
     dot files have a .gv suffix by convention
     """
-    graph_list = []
-    terminal_list = []
-    for node in sorted(game_dict.keys()):
-        if not game_dict[node]['terminal']:
-            for edge in game_dict[node]['actions']:
-                if len(node) > 1:
-                    from_node = str(node).replace(', ', ' ').replace("'", '') 
-                else:
-                    from_node = node[0]
-                if 'values' in game_dict[node]:
-                    from_node += '\\n' + str(game_dict[node]['values'])
-                if len(game_dict[node]['actions'][edge]['next']) > 1:
-                    to_node = str(game_dict[node]['actions'][edge]['next']).replace(', ', ' ').replace("'", '') 
-                else:
-                    to_node = game_dict[node]['actions'][edge]['next'][0]
-                if 'values' in game_dict[game_dict[node]['actions'][edge]['next']]:
-                    to_node += '\\n' + str(game_dict[game_dict[node]['actions'][edge]['next']]['values'])
-                if len(edge) > 1:
-                    edge_label = str(edge).replace(', ', ' ').replace("'", '')
-                else:
-                    edge_label = edge[0]
-                if 'score_count' in game_dict[node]['actions'][edge]:
-                    score_count = []
-                    for idx in range(len(game_dict[node]['actions'][edge]['score_count']) - 1):
-                        score_count.append(int(float(game_dict[node]['actions'][edge]['score_count'][idx]) \
-                                          / float(game_dict[node]['actions'][edge]['score_count'][-1])))
-                    edge_label += '\\n' + str(score_count)
-                graph_list.append('"' + from_node + '" -> "' + to_node + '" [label = "' + edge_label + '"];')
+    props = game['reasoner'].props
+    moves = game['reasoner'].moves
+
+    def label(names):
+        if len(names) > 1:
+            return '(' + ' '.join(names) + ')'
+        return ''.join(names)
+
+    print("digraph game_tree {", file = export_file)
+    print("node [shape = circle];", file = export_file)
+    for number, depth, state, node, edges in export_nodes(game):
+        node_label = label(props.members(state))
+        if node.values is not None:
+            node_label += '\\n' + str(list(node.values))
+        print('n%d [label = "%s"%s];' % (number, node_label, ', shape = doublecircle' if node.terminal else ''),
+          file = export_file)
+        for move, edge, next_number in edges:
+            edge_label = label([moves.names[role_move] for role_move in move])
+            score_count = edge.score_count
+            edge_label += '\\n' + str([int(float(score_count[idx]) / float(score_count[-1])) \
+              for idx in range(len(score_count) - 1)])
+            print('n%d -> n%d [label = "%s"];' % (number, next_number, edge_label), file = export_file)
+    print("}", file = export_file)
+
+def write_jsonl(game, export_file):
+    """
+    Writes one line of JSON per node, with its base propositions, goals if known,
+    depthcharges, and for each edge followed the joint move, the number of the node
+    it leads to, its depthcharges and the average score of each role
+    """
+    props = game['reasoner'].props
+    moves = game['reasoner'].moves
+    for number, depth, state, node, edges in export_nodes(game):
+        print(json.dumps({'id': number, 'depth': depth, 'state': props.members(state),
+          'terminal': bool(node.terminal), 'values': list(node.values) if node.values is not None else None,
+          'visits': node.score_count[-1] if node.score_count is not None else 0,
+          'edges': [{'move': [moves.names[role_move] for role_move in move], 'to': next_number,
+            'visits': edge.score_count[-1], 'average': [round(float(score) / edge.score_count[-1], 1) \
+            for score in edge.score_count[:-1]]} for move, edge, next_number in edges]}, sort_keys = True),
+          file = export_file)
+
+def export_name(game):
+    "DOT_FILE_NAME with the game_id before its extension, so matches played at once each get their own file"
+    root, extension = os.path.splitext(DOT_FILE_NAME)
+    return root + '-' + re.sub(r'[^\w.-]', '_', game['game_id']) + extension
+
+def export_tree(game, filename):
+    "Streams the tree to filename as JSON lines if it ends with .jsonl, otherwise as dot"
+    with open(filename, 'w') as export_file:
+        if filename.endswith('.jsonl'):
+            write_jsonl(game, export_file)
         else:
-            if len(node) > 1:
-                from_node = str(node).replace(', ', ' ').replace("'", '')
-            else:
-                from_node = node[0]
-            from_node += '\\n' + str(game_dict[node]['values'])
-            terminal_list.append('"' + from_node + '"')
-    dot_file = open(filename, "w")
-    print("digraph game_tree {", file = dot_file)
-    print("node [shape = doublecircle]; " + " ".join(terminal_list) + ";", file = dot_file)
-    print("node [shape = circle];", file = dot_file)
-    for element in graph_list:
-        print(element, file = dot_file)
-    print("}", file = dot_file)
-        
+            write_dot(game, export_file)
 
 ##########################################################
 
@@ -291,32 +1433,67 @@ def game2dot(game_dict, filename):
 def info():
     return "((name " + PLAYER_NAME + ")(status available))"
     
-def start(game_id, player, rules, startclock, playclock):
+def start(game_id, player, rules, startclock, playclock, received = None):
+    """
+    received is when the message arrived, which the startclock is counted from.
+    Workers are keyed by game_id and a hash of the rules, so a game_id started
+    again with other rules doesn't get the old reasoner, and each is sent the
+    reasoner once it is ready, so none of them compiles it during a search
+    """
     # print(rules)
-    global game
-    timeout = time.time() + TIME_MARGIN * float(startclock)
-    game = {}
-    game['tree'] = {}
+    if received is None:
+        received = time.time()
+    # registered first since abort may look at the game while it is being built
+    game = {'game_id': game_id, 'halt': threading.Event(), 'worker_key': game_id + '-' + rules_hash(rules)}
+    timeout = deadline(game, received, startclock)
+    with matches_lock:
+        old_game = matches.get(game_id)
+        matches[game_id] = game
+    if old_game is not None:
+        close_game(old_game)
+    game['clock'] = 0
     game['rules'] = rules
-    game['prolog_rules'] = prolog_rules(rules)
+    started = time.time()
+    cache = load_cache(rules)
+    game['reasoner'] = cached_reasoner(rules, cache)
+    game['tree'] = cached_tree(game['reasoner'], cache)
+    print(REASONER + " reasoner ready in %.3f seconds with %d cached nodes" \
+      % (time.time() - started, len(game['tree'])))
+    if worker_pool is not None:
+        game['worker_source'] = worker_source(game)
+        for dummy in range(WORKERS):
+            worker_pool.apply_async(worker_load, (game['worker_key'], game['worker_source'], live_keys()))
     game['playclock'] = playclock
-    game['game_id'] = game_id
     game['player'] = player
+    if INSTRUMENT:
+        game['stats'] = new_stats()
+        game['log'] = []
     game['state'] = findinits(game)
+    game['history'] = [game['state']]
+    if FACTOR:
+        factor_game(game)
     bestmove(game['player'], game['state'], game, timeout)
     return 'ready'
 
-def play(game_id, move):
-    global game
+def play(game_id, move, received = None):
+    if received is None:
+        received = time.time()
+    game = matches[game_id]
     move = rewrite_move(move)
     # print("Move: " + str(move))
     # quit game if moves become garbled due to timeouts or whatever 
-    # if move not in ('nil', 'undefined') and move not in game['tree'][game['state']]['actions'].keys():
+    # if move not in ('nil', 'undefined') and move not in game['tree'][game['state']].actions:
     #    return 'done'
-    timeout = time.time() + TIME_MARGIN * float(game['playclock'])
+    timeout = deadline(game, received, game['playclock'])
+    stop_pondering(game)
     if move not in ('nil', 'undefined'):
+        move = tuple([game['reasoner'].moves.intern(name) for name in move])
         game['state'] = findnext(move, game['state'], game)
+        game['history'].append(game['state'])
     return_move = bestmove(game['player'], game['state'], game, timeout)
+    if PONDER:
+        game['ponder'] = (findroles(game).index(game['player']), return_move)
+    return_move = game['reasoner'].moves.names[return_move]
     idx = return_move.find('(')
     if idx != -1:
         return_move = '( ' + return_move[:idx] + " " + " ".join(return_move[idx + 1: -1].split(',')) + ' )'
@@ -324,41 +1501,101 @@ def play(game_id, move):
     return return_move
     
 def stop(game_id, move):
-    global game
+    game = matches[game_id]
     move = rewrite_move(move)
     # print("Move: ", move)
+    stop_pondering(game)
+    move = tuple([game['reasoner'].moves.intern(name) for name in move])
     game['state'] = findnext(move, game['state'], game)
     # print("State: ", game['state'])
-    # os.remove(PROLOG_FILE_NAME)
+    close_game(game)
+    return 'done'
+
+def stopped(game):
+    "Called by the stop handler once 'done' has been sent, so slow writes don't hold up the answer"
     if DOT_FILE_NAME != False:
-        game2dot(game['tree'], DOT_FILE_NAME)
+        export_tree(game, export_name(game))
+    if CACHE_DIR != False:
+        save_cache(game)
+
+def abort(game_id):
+    """
+    Halts any search first so that the handler holding the match's lock answers
+    at once, then closes the game
+    """
+    game = matches.get(game_id)
+    if game is not None:
+        game['halt'].set()
+        with match_lock(game_id):
+            close_game(game)
     return 'done'
 
+def close_game(game):
+    """
+    Stop the pondering thread and reasoner, which may already have been stopped,
+    and take the game out of matches
+    """
+    stop_pondering(game)
+    if 'reasoner' in game:
+        game['reasoner'].close()
+    with matches_lock:
+        if matches.get(game['game_id']) is game:
+            del matches[game['game_id']]
+            match_locks.pop(game['game_id'], None)
+
 ##########################################################################
  
-def tokenize(chars):
-    "Convert a string of characters into a list of tokens."
-    return chars.replace('(', ' ( ').replace(')', ' ) ').split()
+def read_chunks(rfile, length):
+    "Generator of the length byte body of a message in pieces of READ_SIZE as they arrive"
+    while length > 0:
+        chunk = rfile.read(min(READ_SIZE, length))
+        if len(chunk) == 0:
+            break
+        length -= len(chunk)
+        yield chunk
+
+def tokenize(chunks):
+    """
+    Generator of tokens from a sequence of strings read one after the other.
+    An atom at the end of a chunk is held back in case the next chunk continues it
+    """
+    rest = ''
+    for chunk in chunks:
+        text = rest + chunk
+        rest = ''
+        for match in TOKEN.finditer(text):
+            if match.end() == len(text) and match.group() not in '()':
+                rest = match.group()
+            else:
+                yield match.group()
+    if len(rest) > 0:
+        yield rest
 
 def parse(program):
     "Read a Scheme expression from a string."
-    return read_from_tokens(tokenize(program))
+    return read_from_tokens(tokenize([program]))
 
 def read_from_tokens(tokens):
-    "Read an expression from a sequence of tokens."
-    if len(tokens) == 0:
-        raise SyntaxError('unexpected EOF while reading')
-    token = tokens.pop(0)
-    if '(' == token:
-        L = []
-        while tokens[0] != ')':
-            L.append(read_from_tokens(tokens))
-        tokens.pop(0) # pop off ')'
-        return L
-    elif ')' == token:
-        raise SyntaxError('unexpected )')
-    else:
-        return atom(token)
+    """
+    Read an expression from an iterator of tokens in one pass,
+    with a stack of the lists still open instead of recursion
+    """
+    stack = []
+    for token in tokens:
+        if '(' == token:
+            stack.append([])
+        elif ')' == token:
+            if len(stack) == 0:
+                raise SyntaxError('unexpected )')
+            L = stack.pop()
+            if len(stack) == 0:
+                return L
+            stack[-1].append(L)
+        elif len(stack) == 0:
+            return atom(token)
+        else:
+            stack[-1].append(atom(token))
+    raise SyntaxError('unexpected EOF while reading')
 
 def atom(token):
     "constants are title case, everything else lower case"
@@ -371,9 +1608,9 @@ def atom(token):
 
 # listener
 
-def response(text):
+def response(http, text, content_type = "text/acl"):
     http.send_response(200)
-    http.send_header("Content-type", "text/acl")
+    http.send_header("Content-type", content_type)
     http.send_header("Content-length", len(text))
     http.send_header("Access-Control-Allow-Origin", "*") # replace with origin
     http.send_header("Access-Control-Allow-Methods", "POST, GET, OPTIONS")
@@ -382,51 +1619,155 @@ def response(text):
     http.end_headers()
     http.wfile.write(text)
 
-def http_handler(text):
-    # print(text)
-    result = parse(text)
+def http_handler(http, result, received):
+    """
+    Runs in the request's own thread. info and abort are answered straight away,
+    the handlers for each match take turns with its match_lock, and the tree is
+    rerooted and pondering started only once the answer has been sent
+    """
     # print(result)
     if result[0].lower() == 'info':
-        response(info())
+        response(http, info())
     elif result[0].lower() == 'start':
-        response(start(result[1], result[2], result[3], result[4], result[5]))
+        with match_lock(result[1]):
+            response(http, start(result[1], result[2], result[3], result[4], result[5], received))
+            if result[1] in matches:
+                answered(matches[result[1]])
+            if PONDER and result[1] in matches and not matches[result[1]]['halt'].is_set():
+                ponder(matches[result[1]])
     elif result[0] == 'play':
         # print("Move " + str(result[2]))
-        response(play(result[1], result[2]))
+        with match_lock(result[1]):
+            # checked under the lock, since an abort may have closed the match meanwhile
+            if result[1] not in matches:
+                print("No match " + result[1])
+                response(http, 'done')
+                return
+            response(http, play(result[1], result[2], received))
+            if result[1] in matches:
+                answered(matches[result[1]])
+                # off the clock, since the answer has gone
+                reroot(matches[result[1]])
+            if PONDER and result[1] in matches and not matches[result[1]]['halt'].is_set():
+                ponder(matches[result[1]])
     elif result[0] == 'stop':
-        response(stop(result[1], result[2]))
+        with match_lock(result[1]):
+            if result[1] not in matches:
+                print("No match " + result[1])
+                response(http, 'done')
+                return
+            game = matches[result[1]]
+            response(http, stop(result[1], result[2]))
+        stopped(game)
     elif result[0] == 'abort':
-        response('done')
+        response(http, abort(result[1]))
     else:
         print("Not sure how to respond to " + str(result))
 
+# the games being played, by game_id, and a lock per game_id
+matches = {}
+match_locks = {}
+matches_lock = threading.Lock()
+worker_pool = None
+
+def match_lock(game_id):
+    with matches_lock:
+        return match_locks.setdefault(game_id, threading.Lock())
+
 class myHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def do_POST(self):
-        global http, origin   # origin commented out because of bug in ggp-base
-        http = self
-        origin = self.headers['Origin']
+        received = time.time()
+        # origin = self.headers['Origin'] commented out because of bug in ggp-base
         length = int(self.headers['Content-length'])
-        http_handler(self.rfile.read(length))
- 
-try:
-    arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument("-n", "--hostname", help="hostname, default " + HOST_NAME, type=str)
-    arg_parser.add_argument("-p", "--port", help="port to listen at, default " + str(PORT), type=int)
-    arg_parser.add_argument("-g", "--graphviz", help="generate a dot file for graphviz", type=str)
-    args = arg_parser.parse_args()
-    if args.port:
-        PORT = args.port
-    if args.hostname:
-        HOST_NAME = args.hostname
-    if args.graphviz:
-        DOT_FILE_NAME = args.graphviz
-    server = BaseHTTPServer.HTTPServer((HOST_NAME, PORT), myHTTPRequestHandler)
-    print("Started gameplayer on " + str(PORT))
-    server.serve_forever()
- 
-except KeyboardInterrupt:
-    print("^C received, shutting down the web server")
-    server.server_close()
+        http_handler(self, read_from_tokens(tokenize(read_chunks(self.rfile, length))), received)
 
+    def do_GET(self):
+        "GET /stats answers with the per move logs kept with -i"
+        if self.path == '/stats':
+            response(self, stats_page(), "application/json")
+        else:
+            self.send_error(404)
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    "Each request is handled in its own thread"
+    daemon_threads = True
+ 
+if __name__ == '__main__':
+    try:
+        arg_parser = argparse.ArgumentParser()
+        arg_parser.add_argument("-n", "--hostname", help="hostname, default " + HOST_NAME, type=str)
+        arg_parser.add_argument("-p", "--port", help="port to listen at, default " + str(PORT), type=int)
+        arg_parser.add_argument("-g", "--graphviz", help="export the game tree when a match stops, to the name "
+          "with the game_id added, as JSON lines if the name ends with .jsonl, otherwise as a dot file for graphviz", type=str)
+        arg_parser.add_argument("-d", "--export-depth", help="plies of the tree to export, 0 for all, default " \
+          + str(EXPORT_DEPTH), type=int)
+        arg_parser.add_argument("-v", "--export-visits", help="depthcharges an edge needs to be exported, default " \
+          + str(EXPORT_VISITS), type=int)
+        arg_parser.add_argument("-k", "--export-top", help="most visited edges exported out of each node, "
+          "0 for all, default " + str(EXPORT_TOP), type=int)
+        arg_parser.add_argument("-r", "--reasoner", help="prolog, python or propnet, default " + REASONER,
+          choices=['prolog', 'python', 'propnet'])
+        arg_parser.add_argument("-l", "--depth-limit", help="plies after which a depthcharge is scored by a heuristic, "
+          "0 for no limit, default " + str(PLAYOUT_DEPTH), type=int)
+        arg_parser.add_argument("-b", "--batch", help="depthcharges run in lockstep from each leaf, default " \
+          + str(PLAYOUT_BATCH), type=int)
+        arg_parser.add_argument("-m", "--max-nodes", help="nodes kept in the game tree, 0 for no limit, default " \
+          + str(MAX_NODES), type=int)
+        arg_parser.add_argument("-e", "--eviction", help="lru or visits, default " + EVICTION,
+          choices=['lru', 'visits'])
+        arg_parser.add_argument("-w", "--workers", help="number of depthcharge worker processes, default " \
+          + str(WORKERS), type=int)
+        arg_parser.add_argument("-c", "--cache", help="directory to keep compiled games and opening books in",
+          type=str)
+        arg_parser.add_argument("-o", "--no-ponder", help="don't keep searching between messages",
+          action="store_true")
+        arg_parser.add_argument("-f", "--factor", help="search independent subgames with trees of their own",
+          action="store_true")
+        arg_parser.add_argument("-i", "--instrument", help="log reasoner calls, tree hits and depthcharges per move, "
+          "also served at /stats", action="store_true")
+        args = arg_parser.parse_args()
+        if args.port:
+            PORT = args.port
+        if args.hostname:
+            HOST_NAME = args.hostname
+        if args.graphviz:
+            DOT_FILE_NAME = args.graphviz
+        if args.export_depth is not None:
+            EXPORT_DEPTH = args.export_depth
+        if args.export_visits is not None:
+            EXPORT_VISITS = args.export_visits
+        if args.export_top is not None:
+            EXPORT_TOP = args.export_top
+        if args.reasoner:
+            REASONER = args.reasoner
+        if args.workers:
+            WORKERS = args.workers
+        if args.batch:
+            PLAYOUT_BATCH = args.batch
+        if args.depth_limit is not None:
+            PLAYOUT_DEPTH = args.depth_limit
+        if args.max_nodes is not None:
+            MAX_NODES = args.max_nodes
+        if args.eviction:
+            EVICTION = args.eviction
+        if args.no_ponder:
+            PONDER = False
+        if args.cache:
+            CACHE_DIR = args.cache
+        if args.instrument:
+            INSTRUMENT = True
+        if args.factor:
+            FACTOR = True
+        if WORKERS > 0:
+            # started before any reasoner so the workers don't inherit their pipes
+            worker_pool = multiprocessing.Pool(WORKERS, worker_init)
+        server = ThreadedHTTPServer((HOST_NAME, PORT), myHTTPRequestHandler)
+        print("Started gameplayer on " + str(PORT))
+        server.serve_forever()
 
+    except KeyboardInterrupt:
+        print("^C received, shutting down the web server")
+        server.server_close()
+        if worker_pool is not None:
+            worker_pool.terminate()